@@ -0,0 +1,141 @@
+import os
+import numpy as np
+
+# Columns stored per commit; 'authors' and 'categories' are the lookup tables for the id/code columns
+TABLE_COLUMNS = ('hash', 'author_id', 'timestamp', 'utc_offset', 'file_count', 'diff_lines', 'category')
+
+
+def build_commit_table(commits):
+    """
+    Builds a columnar table (dict of NumPy arrays) from a commits dict, keeping only
+    metadata and the category output: hash, author id, timestamp with its UTC offset,
+    file count, diff line count and category code (-1 when not categorized yet).
+    """
+    authors = {}
+    categories = {}
+    columns = {column: [] for column in TABLE_COLUMNS}
+
+    for commit in commits.values():
+        date = commit['date']
+        if 'diff_lines' in commit:  # Counts recorded before capture budgets
+            diff_lines = sum(commit['diff_lines'].values())
+        else:
+            diff_lines = sum(len(diff.splitlines()) for diff in commit['diffs'].values())
+        category = commit['llama_category']
+
+        columns['hash'].append(commit['hash'])
+        columns['author_id'].append(authors.setdefault(commit['author'], len(authors)))
+        columns['timestamp'].append(int(date.timestamp()))
+        columns['utc_offset'].append(int(date.utcoffset().total_seconds()) if date.utcoffset() else 0)
+        columns['file_count'].append(len(commit['files']))
+        columns['diff_lines'].append(diff_lines)
+        columns['category'].append(categories.setdefault(category, len(categories)) if category else -1)
+
+    return {
+        'hash': np.array(columns['hash'], dtype='S40'),
+        'author_id': np.array(columns['author_id'], dtype=np.int32),
+        'timestamp': np.array(columns['timestamp'], dtype=np.int64),
+        'utc_offset': np.array(columns['utc_offset'], dtype=np.int32),
+        'file_count': np.array(columns['file_count'], dtype=np.int32),
+        'diff_lines': np.array(columns['diff_lines'], dtype=np.int32),
+        'category': np.array(columns['category'], dtype=np.int16),
+        'authors': np.array(list(authors), dtype=str),
+        'categories': np.array(list(categories), dtype=str),
+    }
+
+
+def save_commit_table(table, file_path):
+    """
+    Saves a commit table as a NumPy .npz archive, creating directories if they do not exist.
+    """
+    directory = os.path.dirname(file_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez(file_path, **table)
+
+
+def load_commit_table(file_path):
+    """
+    Loads a commit table saved by save_commit_table, or returns None if it does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path, allow_pickle=False) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+def quarter_index(table):
+    """
+    Returns the quarter of each commit as quarters since 1970, in the author's local time.
+    """
+    local_seconds = table['timestamp'] + table['utc_offset']
+    months = local_seconds.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    return months // 3
+
+
+def quarter_label(index):
+    return f"{1970 + index // 4}-Q{index % 4 + 1}"
+
+
+def count_categories_by_quarter(table):
+    """
+    Counts categorized commits per category and quarter.
+    Returns (category names, quarter labels, counts) where counts[c, q] is the number
+    of commits of category c in quarter q. Only quarters with commits are kept.
+    """
+    categorized = table['category'] >= 0
+    categories = table['category'][categorized]
+    quarters, quarter_codes = np.unique(quarter_index(table)[categorized], return_inverse=True)
+
+    counts = np.zeros((len(table['categories']), len(quarters)), dtype=np.int64)
+    np.add.at(counts, (categories, quarter_codes), 1)
+    return table['categories'].tolist(), [quarter_label(quarter) for quarter in quarters], counts
+
+
+def count_categories(table):
+    """
+    Returns (category names, number of categorized commits per category).
+    """
+    categorized = table['category'][table['category'] >= 0]
+    return table['categories'].tolist(), np.bincount(categorized, minlength=len(table['categories']))
+
+
+def count_by_author(table):
+    """
+    Returns (author names, commits per author, diff lines per author).
+    """
+    n_authors = len(table['authors'])
+    commits = np.bincount(table['author_id'], minlength=n_authors)
+    diff_lines = np.bincount(table['author_id'], weights=table['diff_lines'], minlength=n_authors).astype(np.int64)
+    return table['authors'].tolist(), commits, diff_lines
+
+
+def precision_recall_from_table(table, ground_truth, limit=100):
+    """
+    Vectorized precision, recall and accuracy of the first `limit` categories against
+    ground_truth, with 'Other' as the negative class (see calculate_precision_recall_categorization).
+    """
+    n = min(limit, len(table['category']), len(ground_truth))
+    names = np.append(table['categories'], '')  # Code -1 (not categorized) maps to ''
+    predicted = names[table['category'][:n]]
+    actual = np.array(ground_truth[:n], dtype=str)
+
+    correct = predicted == actual
+    other = predicted == 'Other'
+    TP = int(np.sum(correct & ~other))
+    TN = int(np.sum(correct & other))
+    FP = int(np.sum(~correct & ~other))
+    FN = int(np.sum(~correct & other))
+
+    accuracy = (TP + TN) / (TP + TN + FP + FN)
+    precision = TP / (TP + FP) if TP + FP > 0 else 0
+    recall = TP / (TP + FN) if TP + FN > 0 else 0
+
+    return precision, recall, accuracy
+
+
+def as_commit_table(commits):
+    """
+    Returns commits unchanged if it already is a commit table, otherwise builds one.
+    """
+    return commits if 'categories' in commits else build_commit_table(commits)
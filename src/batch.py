@@ -0,0 +1,171 @@
+import os
+import sys
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from inference import _put
+from utils import load_commits, save_commits, save_commit_fields, full_path
+from utils import iter_new_commits, key_commits_by_hash, DEFAULT_CAPTURE_POLICY
+from categorization import ask_model_categorization_batch, generate_prompt_categorization_few_shots
+from summary import ask_model_summarization_batch, generate_prompt_summarization_few_shots
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest with one local repository path per line, optionally followed by
+    the branch to analyze (default: the checked out one).
+    Blank lines and lines starting with '#' are ignored.
+    Returns (repo_path, branch or None) pairs.
+    """
+    with open(manifest_path) as file:
+        lines = [line.strip() for line in file]
+    entries = []
+    for line in lines:
+        if line and not line.startswith('#'):
+            repo_path, _, branch = line.rpartition(' ')
+            if not repo_path or os.path.isdir(line):  # No branch, or a path with spaces
+                repo_path, branch = line, ''
+            entries.append((repo_path.strip(), branch or None))
+    return entries
+
+
+def repo_output_directory(output_directory, repo_path):
+    """
+    Returns the directory where the results of one repository are written: its name
+    and a short hash of its absolute path, so repositories with the same name do not
+    share a store.
+    """
+    absolute_path = os.path.abspath(os.path.normpath(repo_path))
+    path_hash = hashlib.sha1(absolute_path.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(output_directory, f"{os.path.basename(absolute_path)}-{path_hash}")
+
+
+def annotate_commits(commits, pipe, batch_size=8):
+    """
+    Runs few-shot summarization and categorization on commits with the batched model
+    calls, skipping fields already filled.
+    """
+    for field, generate_prompt, ask_model_batch in (
+            ('llama_summary', generate_prompt_summarization_few_shots, ask_model_summarization_batch),
+            ('llama_category', generate_prompt_categorization_few_shots, ask_model_categorization_batch)):
+        pending = [commit for commit in commits if not commit[field]]
+        if pending:
+            answers = ask_model_batch([generate_prompt(commit) for commit in pending], pipe, batch_size)
+            for commit, answer in zip(pending, answers):
+                commit[field] = answer
+    return commits
+
+
+def run_batch(repos, pipe, output_directory, workers=4, branch='HEAD', queue_size=256, batch_size=8):
+    """
+    Analyzes several repositories in one run.
+
+    Up to `workers` repositories are walked at the same time, each by an extraction
+    thread that pushes its new commits into one bounded queue as soon as they are
+    normalized. The calling thread drains the queue through the model, up to
+    batch_size commits per model call, so inference never waits for a whole
+    repository to be extracted. Results and watermarks are written per repository
+    under output_directory. If the model fails, the extraction threads stop without
+    moving their watermarks and the error is raised.
+
+    repos holds repository paths or (path, branch) pairs as returned by read_manifest;
+    branch is used for the repositories without one.
+    """
+    commits_queue = queue.Queue(maxsize=queue_size)
+    stores = {}
+    store_lock = threading.Lock()
+    stopped = threading.Event()  # Set when the model fails, nothing drains the queue anymore
+
+    def put(item):
+        return _put(commits_queue, item, lambda: not stopped.is_set())[1]
+
+    def produce(repo_path, repo_branch):
+        directory = repo_output_directory(output_directory, repo_path)
+        store_path = full_path(directory, "few_shots")
+        watermarks_path = full_path(directory, "watermarks")
+
+        store = key_commits_by_hash(load_commits(store_path) or {})
+        with store_lock:
+            stores[repo_path] = store
+            pending = [commit for commit in store.values() if not commit['llama_category']]
+        # Resume commits left unprocessed by an interrupted run
+        for commit in pending:
+            if not put((repo_path, store_path, commit)):
+                return
+
+        watermarks = load_commits(watermarks_path) or {}
+        for commit in iter_new_commits(repo_path, watermarks, repo_branch, DEFAULT_CAPTURE_POLICY):
+            with store_lock:
+                store[commit['hash']] = commit
+            if not put((repo_path, store_path, commit)):
+                return  # The commits not journaled yet are extracted again by the next run
+
+        # Persist the new commits before moving the watermark past them
+        with store_lock:
+            save_commits(store, store_path)
+        save_commits(watermarks, watermarks_path)
+
+    processed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for repo in repos:
+            repo_path, repo_branch = (repo, None) if isinstance(repo, str) else repo
+            futures.append(executor.submit(produce, repo_path, repo_branch or branch))
+
+        try:
+            while not all(future.done() for future in futures) or not commits_queue.empty():
+                try:
+                    items = [commits_queue.get(timeout=1)]
+                except queue.Empty:
+                    continue
+                while len(items) < batch_size:
+                    try:
+                        items.append(commits_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                annotate_commits([commit for _, _, commit in items], pipe, batch_size)
+                # Under the lock, so a snapshot from the extraction thread cannot drop the journal line
+                with store_lock:
+                    for _, store_path, commit in items:
+                        save_commit_fields(commit, ['llama_summary', 'llama_category'], store_path)
+                processed += len(items)
+        except BaseException:
+            stopped.set()  # Unblocks the extraction threads, the executor can then shut down
+            raise
+
+        for future in futures:
+            future.result()  # Re-raise extraction errors
+
+    print(f"Processed {processed} commits from {len(repos)} repositories")
+    return stores
+
+
+if __name__ == "__main__":
+    # Usage: python batch.py <manifest> [output_directory] [workers] [branch]
+    import torch
+    from transformers import pipeline
+    from inference import LazyPipeline
+    from prompt_budget import budgeted
+    from response_cache import ResponseCache, CachedPipe
+
+    MANIFEST_PATH = sys.argv[1]
+    OUTPUT_DIRECTORY = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.getcwd(), 'batch_results')
+    EXTRACTION_WORKERS = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    BRANCH = sys.argv[4] if len(sys.argv) > 4 else 'HEAD'
+    INFERENCE_BATCH_SIZE = 8
+    DEVICE_USED = 0 if torch.cuda.is_available() else -1
+
+    # Avoid warning related to parallelization
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    # Same wrapping as main.py: loaded on the first call, budgeted prompts, cached answers
+    PIPE_LLAMA = LazyPipeline(lambda: pipeline("text-generation", model="meta-llama/Llama-3.2-1B-Instruct",
+                                               pad_token_id=128001, device=DEVICE_USED))
+    generate_prompt_categorization_few_shots = budgeted(generate_prompt_categorization_few_shots, 'categorization', PIPE_LLAMA)
+    generate_prompt_summarization_few_shots = budgeted(generate_prompt_summarization_few_shots, 'summarization', PIPE_LLAMA)
+    RESPONSE_CACHE = ResponseCache(os.path.join(OUTPUT_DIRECTORY, "llm_responses.sqlite"))
+    PIPE_LLAMA = CachedPipe(PIPE_LLAMA, RESPONSE_CACHE, model_id="meta-llama/Llama-3.2-1B-Instruct")
+
+    run_batch(read_manifest(MANIFEST_PATH), PIPE_LLAMA, OUTPUT_DIRECTORY, EXTRACTION_WORKERS, BRANCH,
+              batch_size=INFERENCE_BATCH_SIZE)
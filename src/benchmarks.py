@@ -0,0 +1,755 @@
+import os, sys, copy, json, time, pickle, random, shutil, threading, subprocess, tracemalloc
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from itertools import islice
+from utils import extract_git_commits, extract_git_commits_streaming, extract_git_commits_parallel
+from utils import filter_trivial_commits, normalize_commit_data, key_commits_by_hash, iter_commits_pipeline
+from utils import DEFAULT_CAPTURE_POLICY, save_commits, save_commit_fields, load_commits, make_experiment, extract_new_commits
+from utils import calculate_precision_recall_categorization
+from commit_record import Commit
+from blob_store import DiffBlobStore, externalize_diffs, _open_stores
+from categorization import ask_model_categorization, ask_model_categorization_batch, ask_model_categorization_scored, generate_prompt_categorization_few_shots
+from summary import ask_model_summarization, ask_model_summarization_batch, generate_prompt_summarization_few_shots
+from tech_summary import ask_model_technical_analysis, ask_model_quality_assurance, generate_prompt_technical_analysis, generate_quality_assurance_prompt
+from stopping import GENERATION_STATS, print_generation_stats
+from prompt_budget import BUDGET_STATS, budgeted, encode, print_budget_stats
+from utils import journal_path, full_path
+from response_cache import ResponseCache, CachedPipe
+from prefix_cache import PrefixCachedPipe, static_prefix
+from inference import optimize_for_cpu, annotate_in_batches, annotate_staged, print_stage_stats, STAGE_STATS
+from inference_server import InferenceServer
+from multi_task import MultiTaskPipe
+from sharded import run_sharded, shard_of, shard_path
+from batch import run_batch, repo_output_directory
+
+
+def make_synthetic_repo(repo_path, n_commits=20000, n_files=200, seed=42):
+    """
+    Creates a local repository with n_commits linear commits using `git fast-import`.
+    Each commit edits a few random C-like files, so diffs resemble a real history.
+    """
+    rng = random.Random(seed)
+    subprocess.run(['git', 'init', '-q', '-b', 'master', repo_path], check=True)
+    files = {f"src/module_{i}.c": [f"int value_{i}_{j} = {j};" for j in range(20)] for i in range(n_files)}
+
+    stream = []
+    for i in range(n_commits):
+        message = f"Change {i}: update values"
+        timestamp = 1500000000 + i * 600
+        stream.append(f"commit refs/heads/master\nmark :{i + 1}\n"
+                      f"committer Dev {i % 17} <dev{i % 17}@example.com> {timestamp} +0000\n"
+                      f"data {len(message)}\n{message}\n")
+        if i > 0:
+            stream.append(f"from :{i}\n")
+        touched = files.keys() if i == 0 else rng.sample(sorted(files), 3)
+        for path in touched:
+            lines = files[path]
+            lines[rng.randrange(len(lines))] = f"int changed_{i} = {rng.randrange(1000)};"
+            content = '\n'.join(lines) + '\n'
+            stream.append(f"M 100644 inline {path}\ndata {len(content)}\n{content}\n")
+
+    subprocess.run(['git', '-C', repo_path, 'fast-import', '--quiet'],
+                   input=''.join(stream).encode('utf-8'), check=True)
+    subprocess.run(['git', '-C', repo_path, 'checkout', '-q', 'master'], check=True)
+    return repo_path
+
+
+def time_call(function, *args, **kwargs):
+    """
+    Runs function once and returns (result, elapsed seconds).
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_extraction(repo_path):
+    """
+    Compares the GitPython extraction path with the streaming `git log -p` backend.
+    """
+    gitpython_commits, gitpython_time = time_call(extract_git_commits, repo_path)
+    streaming_commits, streaming_time = time_call(extract_git_commits_streaming, repo_path)
+
+    # The root commit is diffed differently by the two backends, skip it
+    last = len(gitpython_commits) - 1
+    same = all(gitpython_commits[i] == streaming_commits[i] for i in range(last))
+
+    print(f"GitPython:  {gitpython_time:.2f}s ({len(gitpython_commits) / gitpython_time:.0f} commits/s)")
+    print(f"Streaming:  {streaming_time:.2f}s ({len(streaming_commits) / streaming_time:.0f} commits/s)")
+    print(f"Speedup:    {gitpython_time / streaming_time:.1f}x, identical output: {same}")
+
+
+
+def benchmark_parallel_extraction(repo_path, workers=(1, 2, 4, 8)):
+    """
+    Measures how extraction + filtering + normalization scales with the process pool size.
+    """
+    def serial():
+        return key_commits_by_hash(normalize_commit_data(filter_trivial_commits(extract_git_commits_streaming(repo_path))))
+
+    serial_commits, serial_time = time_call(serial)
+    print(f"Serial:     {serial_time:.2f}s")
+    for n_workers in workers:
+        parallel_commits, parallel_time = time_call(extract_git_commits_parallel, repo_path, workers=n_workers)
+        same = list(parallel_commits.items()) == list(serial_commits.items())
+        print(f"{n_workers} workers:  {parallel_time:.2f}s, speedup {serial_time / parallel_time:.1f}x, identical output: {same}")
+
+
+
+def peak_memory(function, *args, **kwargs):
+    """
+    Runs function once and returns its peak Python heap usage in MB.
+    """
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def benchmark_pipeline_memory(repo_path):
+    """
+    Compares peak memory of the dict-based extract/filter/normalize chain with
+    the generator pipeline consumed one commit at a time.
+    """
+    def dict_chain():
+        normalize_commit_data(filter_trivial_commits(extract_git_commits_streaming(repo_path)))
+
+    def generator_chain():
+        for _ in iter_commits_pipeline(repo_path):
+            pass
+
+    print(f"Dict chain peak:       {peak_memory(dict_chain):.1f} MB")
+    print(f"Generator chain peak:  {peak_memory(generator_chain):.1f} MB")
+
+
+
+def benchmark_capture_policy(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY):
+    """
+    Compares the pickled size of the extracted commits with and without a capture policy.
+    """
+    full_size = len(pickle.dumps(extract_git_commits_streaming(repo_path)))
+    captured = extract_git_commits_streaming(repo_path, capture_policy=capture_policy)
+    captured_size = len(pickle.dumps(captured))
+    skipped = sum(len(commit['skipped_files']) for commit in captured.values())
+
+    print(f"Full diffs:      {full_size / 2**20:.1f} MB")
+    print(f"Capture policy:  {captured_size / 2**20:.1f} MB ({full_size / captured_size:.1f}x smaller, {skipped} files skipped)")
+
+
+
+def benchmark_cat_file(repo_path):
+    """
+    Compares the GitPython extraction path (two git processes per commit) with the
+    same path reading objects through one persistent `git cat-file --batch` process.
+    """
+    gitpython_commits, gitpython_time = time_call(extract_git_commits, repo_path)
+    cat_file_commits, cat_file_time = time_call(extract_git_commits, repo_path, use_cat_file=True)
+
+    # The root commit is diffed differently by the two paths, skip it
+    last = len(gitpython_commits) - 1
+    same = sum(gitpython_commits[i] == cat_file_commits[i] for i in range(last))
+
+    print(f"Per-call processes:  {gitpython_time:.2f}s")
+    print(f"cat-file --batch:    {cat_file_time:.2f}s, speedup {gitpython_time / cat_file_time:.1f}x, identical commits: {same}/{last}")
+
+
+
+def benchmark_checkpoints(repo_path, checkpoint_directory='./checkpoint_benchmark'):
+    """
+    Compares checkpointing every processed commit by re-pickling the whole store
+    with appending the changed field to the journal, and the time to resume.
+    """
+    commits = extract_git_commits_streaming(repo_path)
+    pickle_path = os.path.join(checkpoint_directory, "commits_pickle.pkl")
+    journal_store_path = os.path.join(checkpoint_directory, "commits_journal.pkl")
+    save_commits(commits, journal_store_path)
+
+    def full_pickle():
+        for commit in commits.values():
+            commit['llama_category'] = 'Other'
+            save_commits(commits, pickle_path)
+
+    def journal():
+        for commit in commits.values():
+            commit['llama_category'] = 'Other'
+            save_commit_fields(commit, ['llama_category'], journal_store_path)
+
+    _, pickle_time = time_call(full_pickle)
+    _, journal_time = time_call(journal)
+    _, load_time = time_call(load_commits, journal_store_path)
+    print(f"Re-pickle per commit:  {pickle_time:.2f}s")
+    print(f"Journal per commit:    {journal_time:.2f}s ({pickle_time / journal_time:.0f}x faster), resume with compaction {load_time:.2f}s")
+
+
+
+def benchmark_experiment_memory(repo_path, n_experiments=2):
+    """
+    Compares the memory of one deep copy of the commits per experiment with
+    experiment views that share the records and only hold their outputs.
+    """
+    commits = key_commits_by_hash(extract_git_commits_streaming(repo_path))
+
+    def deep_copies():
+        experiments = [copy.deepcopy(commits) for _ in range(n_experiments)]
+        for experiment in experiments:
+            for commit in experiment.values():
+                commit['llama_category'] = 'Other'
+        return experiments
+
+    def overlays():
+        experiments = [make_experiment(commits, {}) for _ in range(n_experiments)]
+        for experiment in experiments:
+            for commit in experiment.values():
+                commit['llama_category'] = 'Other'
+        return experiments
+
+    print(f"Deep copies ({n_experiments} experiments):  {peak_memory(deep_copies):.1f} MB")
+    print(f"Overlays ({n_experiments} experiments):     {peak_memory(overlays):.1f} MB")
+
+
+
+def make_synthetic_commits(record_type, n_commits=100000, n_authors=50, n_files=2000, seed=42):
+    """
+    Builds n_commits in-memory commit records of the given type (dict or Commit),
+    with fresh author and path strings per commit, as the extractors produce them.
+    """
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    commits = {}
+    for i in range(n_commits):
+        author_id = rng.randrange(n_authors)
+        paths = [f"src/module_{rng.randrange(n_files)}.c" for _ in range(3)]
+        commits[i] = record_type({
+            'hash': f"{rng.getrandbits(160):040x}",
+            'author': f"Developer {author_id} <developer{author_id}@example.com>",
+            'date': start + timedelta(minutes=10 * i),
+            'message': f"Change {i}.",
+            'files': paths,
+            'diffs': {path: f"-int value = {i};\n+int value = {i + 1};" for path in paths},
+            'llama_summary': '',
+            'llama_category': '',
+            'llama_tech_summary': ''
+        })
+    return commits
+
+
+def benchmark_commit_record(n_commits=100000):
+    """
+    Compares the memory of plain commit dicts with Commit records.
+    """
+    print(f"Dict records ({n_commits}):    {peak_memory(make_synthetic_commits, dict, n_commits):.1f} MB")
+    print(f"Commit records ({n_commits}):  {peak_memory(make_synthetic_commits, Commit, n_commits):.1f} MB")
+
+
+
+def benchmark_diff_store(repo_path, store_directory='./diff_store_benchmark'):
+    """
+    Reports the deduplication ratio of the content-addressed diff store and the time
+    to load the commits with inline diffs versus with references into the store.
+    """
+    commits = extract_git_commits_streaming(repo_path)
+    inline_path = os.path.join(store_directory, "commits_inline.pkl")
+    stored_path = os.path.join(store_directory, "commits_stored.pkl")
+    blobs_path = os.path.join(store_directory, "commits_diffs.blobs")
+    for path in (inline_path, stored_path, blobs_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    save_commits(commits, inline_path)
+    store = DiffBlobStore(blobs_path)
+    externalize_diffs(commits, store)
+    save_commits(commits, stored_path)
+    total_bytes = store.written_bytes + store.deduplicated_bytes
+    store.close()
+
+    _, inline_time = time_call(load_commits, inline_path)
+    _, stored_time = time_call(load_commits, stored_path)  # Includes reopening and indexing the store
+    print(f"Diff bytes: {total_bytes / 2**20:.1f} MB, stored once: {store.written_bytes / 2**20:.1f} MB "
+          f"(dedup ratio {total_bytes / max(store.written_bytes, 1):.2f}x)")
+    print(f"Pickle size: inline {os.path.getsize(inline_path) / 2**20:.1f} MB, with references {os.path.getsize(stored_path) / 2**20:.1f} MB")
+    print(f"Load time:   inline {inline_time:.3f}s, with references {stored_time:.3f}s")
+    _open_stores[os.path.abspath(blobs_path)].close()
+
+
+
+def benchmark_batched_inference(repo_path, pipe, batch_sizes=(1, 4, 8, 16), n_commits=64):
+    """
+    Compares the commits/sec of few-shot categorization one prompt at a time (the
+    original loop of main.py) with the length-bucketed batched path, and how many
+    categories the batched path reproduces.
+    """
+    commits = normalize_commit_data(filter_trivial_commits(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY)))
+    prompts = [generate_prompt_categorization_few_shots(commit) for commit in list(commits.values())[:n_commits]]
+
+    serial, serial_time = time_call(lambda: [ask_model_categorization(prompt, pipe) for prompt in prompts])
+    print(f"One at a time: {len(prompts) / serial_time:.2f} commits/s")
+    for batch_size in batch_sizes:
+        batched, batched_time = time_call(ask_model_categorization_batch, prompts, pipe, batch_size)
+        agreement = sum(a == b for a, b in zip(serial, batched)) / len(prompts)
+        print(f"Batch size {batch_size:>3}: {len(prompts) / batched_time:.2f} commits/s "
+              f"({serial_time / batched_time:.1f}x, {agreement:.0%} same categories)")
+
+
+
+def benchmark_prefix_cache(repo_path, pipe, n_commits=16):
+    """
+    Compares the time to first token of the three few-shot templates with and without
+    the key/values of their static prefix cached.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    templates = [generate_prompt_categorization_few_shots, generate_prompt_summarization_few_shots, generate_prompt_technical_analysis]
+    cached_pipe = PrefixCachedPipe(pipe, [static_prefix(template) for template in templates])
+    first_token = dict(max_new_tokens=1, do_sample=False, temperature=None, top_p=None)
+
+    print(f"Device: {pipe.model.device}")
+    for template in templates:
+        prompts = [template(commit) for commit in commits]
+        prefix_tokens = len(pipe.tokenizer(static_prefix(template)).input_ids)
+        _, plain_time = time_call(lambda: [pipe(prompt, **first_token) for prompt in prompts])
+        _, cached_time = time_call(lambda: [cached_pipe(prompt, **first_token) for prompt in prompts])
+        print(f"{template.__name__}: {prefix_tokens} prefix tokens, time to first token "
+              f"{1000 * plain_time / len(prompts):.0f} ms -> {1000 * cached_time / len(prompts):.0f} ms "
+              f"({plain_time / cached_time:.1f}x)")
+    print(f"Prefix cache hits: {cached_pipe.hits}, misses: {cached_pipe.misses}")
+
+
+
+def benchmark_prefix_cache_batched(repo_path, pipe, n_commits=4, batch_size=8):
+    """
+    Checks that the batched path through a PrefixCachedPipe (which runs prompts one at
+    a time) stops each prompt by its own answer: the categories and summaries of a list
+    of prompts must be those of the prompts run alone, one GENERATION_STATS sequence each.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    templates = [generate_prompt_categorization_few_shots, generate_prompt_summarization_few_shots]
+    cached_pipe = PrefixCachedPipe(pipe, [static_prefix(template) for template in templates])
+    for template, ask_model_batch, task in ((generate_prompt_categorization_few_shots, ask_model_categorization_batch, 'categorization'),
+                                            (generate_prompt_summarization_few_shots, ask_model_summarization_batch, 'summarization')):
+        prompts = [template(commit) for commit in commits]
+        alone = [ask_model_batch([prompt], cached_pipe, 1)[0] for prompt in prompts]
+        sequences = GENERATION_STATS.get(task, {}).get('sequences', 0)
+        batched = ask_model_batch(prompts, cached_pipe, batch_size)
+        sequences = GENERATION_STATS[task]['sequences'] - sequences
+        print(f"{task}: same answers as one prompt per call: {batched == alone}, "
+              f"{sequences} sequences counted for {len(prompts)} prompts")
+
+
+
+def benchmark_category_scoring(repo_path, pipe, n_commits=32):
+    """
+    Compares few-shot categorization by free generation with scoring the categories
+    in one forward pass: commits/sec, agreement and mean confidence of the scored choice.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    prompts = [generate_prompt_categorization_few_shots(commit) for commit in commits]
+
+    generated, generate_time = time_call(lambda: [ask_model_categorization(prompt, pipe) for prompt in prompts])
+    scored, score_time = time_call(lambda: [ask_model_categorization_scored(prompt, pipe) for prompt in prompts])
+    agreement = sum(category == scored_category for category, (scored_category, _) in zip(generated, scored)) / len(prompts)
+    confidence = sum(confidences[category] for category, confidences in scored) / len(prompts)
+
+    print(f"Generation: {len(prompts) / generate_time:.2f} commits/s")
+    print(f"Scoring:    {len(prompts) / score_time:.2f} commits/s ({generate_time / score_time:.1f}x), "
+          f"{agreement:.0%} same categories, mean confidence {confidence:.2f}")
+
+
+
+def benchmark_stopping(repo_path, pipe, n_commits=8):
+    """
+    Runs every few-shot task with its stopping rules on a few commits and reports,
+    per task, the tokens generated and the tokens saved against the max_new_tokens cap.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    GENERATION_STATS.clear()
+    for commit in commits:
+        ask_model_categorization(generate_prompt_categorization_few_shots(commit), pipe)
+        ask_model_summarization(generate_prompt_summarization_few_shots(commit), pipe)
+        technical_summary = ask_model_technical_analysis(generate_prompt_technical_analysis(commit), pipe)
+        ask_model_quality_assurance(generate_quality_assurance_prompt(technical_summary), pipe)
+    print_generation_stats()
+
+
+
+def benchmark_prompt_budget(repo_path, pipe=None, max_tokens=None):
+    """
+    Compares the token count of the few-shot categorization prompts with and without
+    the prompt budget (4-character pieces stand in for tokens without a pipeline).
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())
+    budgeted_prompt = budgeted(generate_prompt_categorization_few_shots, 'categorization', pipe, max_tokens)
+    tokenizer = getattr(pipe, 'tokenizer', None)
+    BUDGET_STATS.clear()
+
+    for name, generate_prompt in (("Unbounded", generate_prompt_categorization_few_shots), ("Budgeted", budgeted_prompt)):
+        prompts, build_time = time_call(lambda: [generate_prompt(commit) for commit in commits])
+        lengths = sorted(len(encode(tokenizer, prompt)) for prompt in prompts)
+        print(f"{name}: mean {sum(lengths) / len(lengths):.0f} tokens, p95 {lengths[int(0.95 * (len(lengths) - 1))]}, "
+              f"max {lengths[-1]}, built in {build_time:.2f}s")
+    print_budget_stats()
+
+
+
+def benchmark_response_cache(repo_path, pipe, n_commits=32, cache_path='./response_cache_benchmark/responses.sqlite'):
+    """
+    Runs few-shot categorization twice through an empty response cache, as a re-run of
+    main.py would, and reports the time of each pass and the hit rates.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    prompts = [generate_prompt_categorization_few_shots(commit) for commit in commits]
+    for path in (cache_path, cache_path + '-wal', cache_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    cache = ResponseCache(cache_path)
+    cached_pipe = CachedPipe(pipe, cache)
+    first, first_time = time_call(lambda: [ask_model_categorization(prompt, cached_pipe) for prompt in prompts])
+    second, second_time = time_call(lambda: [ask_model_categorization(prompt, cached_pipe) for prompt in prompts])
+    print(f"First run:  {first_time:.2f}s")
+    print(f"Re-run:     {second_time:.2f}s ({first_time / second_time:.0f}x faster), same answers: {first == second}")
+    cache.print_stats()
+    cache.close()
+
+
+
+def benchmark_cpu_modes(repo_path, model="meta-llama/Llama-3.2-1B-Instruct", ground_truth_path=None,
+                        modes=('fp32', 'bf16', 'int8'), threads=None, n_commits=100, batch_size=8):
+    """
+    Categorizes the first n_commits commits (few-shot) on the CPU with the model loaded
+    in each mode of inference.optimize_for_cpu, and reports throughput next to precision,
+    recall and accuracy against the labels of ground_truth_path (a JSON list, one category
+    per commit of the filtered, normalized history as main.py stores it; by default the
+    100 handcrafted labels of the first mujs commits used in the report).
+    """
+    from transformers import pipeline
+    ground_truth_path = ground_truth_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ground_truth_categories.json')
+    with open(ground_truth_path) as file:
+        ground_truth = json.load(file)
+    # Trivial commits filtered out first, like the commits the labels were written for
+    commits = key_commits_by_hash(dict(islice(iter_commits_pipeline(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY), n_commits)))
+    prompts = [generate_prompt_categorization_few_shots(commit) for commit in commits.values()]
+
+    categories = {}
+    for mode in modes:
+        pipe = optimize_for_cpu(pipeline("text-generation", model=model, device=-1), mode, threads)
+        answers, elapsed = time_call(ask_model_categorization_batch, prompts, pipe, batch_size)
+        experiment = make_experiment(commits, {})
+        for commit, category in zip(experiment.values(), answers):
+            commit['llama_category'] = category
+        precision, recall, accuracy = calculate_precision_recall_categorization(experiment, ground_truth)
+        agreement = ''
+        if 'fp32' in categories:
+            agreement = f", same category as fp32: {sum(a == b for a, b in zip(answers, categories['fp32']))}/{len(answers)}"
+        categories[mode] = answers
+        print(f"{mode:5} {len(prompts) / elapsed:6.2f} commits/s  precision {precision:.2f}  recall {recall:.2f}  "
+              f"accuracy {accuracy:.2f}{agreement}")
+
+
+
+class StubPipe:
+    """
+    Offline stand-in for the text-generation pipeline: each call costs call_latency
+    seconds plus prompt_latency per prompt, like a forward pass on a batch, and
+    answers with the last line of each prompt.
+    """
+
+    def __init__(self, call_latency=0.05, prompt_latency=0.005):
+        self.call_latency = call_latency
+        self.prompt_latency = prompt_latency
+        self.calls = 0
+
+    def __call__(self, prompts, **generate_kwargs):
+        batch = [prompts] if isinstance(prompts, str) else prompts
+        self.calls += 1
+        time.sleep(self.call_latency + self.prompt_latency * len(batch))
+        outputs = [[{'generated_text': prompt.rstrip().rsplit('\n', 1)[-1]}] for prompt in batch]
+        return outputs[0] if isinstance(prompts, str) else outputs
+
+
+def benchmark_inference_server(repo_path, pipe=None, n_commits=32, batch_size=8, max_wait=0.02):
+    """
+    Runs the few-shot summarization and categorization chains one after the other on
+    the pipeline, then both at once as clients of an InferenceServer merging their
+    requests, and compares time, model calls and answers. Without a pipe a StubPipe is used.
+    """
+    pipe = pipe or StubPipe()
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    summary_prompts = [generate_prompt_summarization_few_shots(commit) for commit in commits]
+    category_prompts = [generate_prompt_categorization_few_shots(commit) for commit in commits]
+
+    def serial():
+        return (ask_model_summarization_batch(summary_prompts, pipe, batch_size),
+                ask_model_categorization_batch(category_prompts, pipe, batch_size))
+
+    def concurrent(server):
+        answers = {}
+        chains = [threading.Thread(target=lambda: answers.update(summaries=ask_model_summarization_batch(summary_prompts, server, batch_size))),
+                  threading.Thread(target=lambda: answers.update(categories=ask_model_categorization_batch(category_prompts, server, batch_size)))]
+        for chain in chains:
+            chain.start()
+        for chain in chains:
+            chain.join()
+        return answers['summaries'], answers['categories']
+
+    serial_answers, serial_time = time_call(serial)
+    with InferenceServer(pipe, 2 * batch_size, max_wait) as server:
+        server_answers, server_time = time_call(concurrent, server)
+    print(f"Chains one after the other:  {serial_time:.2f}s, {2 * -(-n_commits // batch_size)} model calls")
+    print(f"Chains on the server:        {server_time:.2f}s ({serial_time / server_time:.1f}x faster), "
+          f"{server.batches} model calls, same answers: {serial_answers == server_answers}")
+
+
+
+def benchmark_prompt_lookup(repo_path, pipe, n_commits=8, prompt_lookup_num_tokens=10):
+    """
+    Runs few-shot summarization (greedy) and technical analysis (sampled) one prompt at
+    a time with and without prompt lookup decoding, and reports the generated tokens per
+    second of each and whether the summaries are identical.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    tasks = (('summarization', ask_model_summarization, generate_prompt_summarization_few_shots),
+             ('technical_analysis', ask_model_technical_analysis, generate_prompt_technical_analysis))
+    for task, ask_model, generate_prompt in tasks:
+        prompts = [generate_prompt(commit) for commit in commits]
+        answers = {}
+        for num_tokens in (None, prompt_lookup_num_tokens):
+            GENERATION_STATS.clear()
+            answers[num_tokens], elapsed = time_call(lambda: [ask_model(prompt, pipe, num_tokens) for prompt in prompts])
+            generated = GENERATION_STATS[task]['generated_tokens']
+            print(f"{task}, prompt lookup {num_tokens or 'off'}: {generated / elapsed:.1f} tokens/s ({generated} tokens in {elapsed:.2f}s)")
+        if task == 'summarization':
+            print(f"Same summaries: {answers[None] == answers[prompt_lookup_num_tokens]}")
+
+
+
+def benchmark_multi_task(repo_path, pipe, n_commits=8):
+    """
+    Compares answering the category, summary and technical analysis of each commit with
+    the three chains' own prompts and with one MultiTaskPipe pass (context prefilled once
+    per commit), and reports the prompt tokens prefilled per commit and the time.
+    """
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    tokenizer = pipe.tokenizer
+    prompts = [(generate_prompt_categorization_few_shots(commit), generate_prompt_summarization_few_shots(commit),
+                generate_prompt_technical_analysis(commit)) for commit in commits]
+
+    def separate():
+        for categorization, summarization, technical_analysis in prompts:
+            ask_model_categorization(categorization, pipe)
+            ask_model_summarization(summarization, pipe)
+            ask_model_technical_analysis(technical_analysis, pipe)
+
+    _, separate_time = time_call(separate)
+    separate_tokens = sum(len(tokenizer(prompt).input_ids) for commit_prompts in prompts for prompt in commit_prompts)
+    multi_task = MultiTaskPipe(pipe)
+    _, multi_task_time = time_call(lambda: [multi_task.annotate(commit) for commit in commits])
+    print(f"Chain prompts:  {separate_tokens / len(commits):.0f} prompt tokens prefilled per commit, {separate_time:.2f}s")
+    print(f"Multi-task:     {multi_task.prefilled_tokens / len(commits):.0f} prompt tokens prefilled per commit "
+          f"(+ {multi_task.preamble_ids.shape[1]} once), {multi_task_time:.2f}s")
+
+
+
+def benchmark_staged_pipeline(repo_path, pipe=None, n_commits=256, batch_size=8, checkpoint_every=32,
+                              work_directory='./staged_benchmark'):
+    """
+    Annotates few-shot summaries (with the prompt budget) through annotate_in_batches
+    and annotate_staged, and compares the time, the journaled answers and the
+    utilization of each stage. Without a pipe a StubPipe is used.
+    """
+    pipe = pipe or StubPipe()
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    generate_prompt = budgeted(generate_prompt_summarization_few_shots, 'summarization', pipe)
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+
+    outputs = {}
+    for name, annotate in (("Serial", annotate_in_batches), ("Staged", annotate_staged)):
+        store_path = os.path.join(work_directory, f"{name.lower()}.pkl")
+        experiment = make_experiment({commit['hash']: commit for commit in commits}, {})
+        _, elapsed = time_call(annotate, list(experiment.values()), 'llama_summary', generate_prompt,
+                               ask_model_summarization_batch, pipe, store_path, batch_size, checkpoint_every)
+        with open(journal_path(store_path), encoding="utf-8") as file:
+            outputs[name] = file.read()
+        print(f"{name}: {elapsed:.2f}s")
+    print(f"Same journal: {outputs['Serial'] == outputs['Staged']}")
+    print_stage_stats()
+    STAGE_STATS.clear()
+
+
+
+def benchmark_sharded(repo_path, pipe=None, devices=(-1, -1, -1, -1), n_commits=256, batch_size=8, checkpoint_every=32,
+                      work_directory='./sharded_benchmark'):
+    """
+    Annotates few-shot summaries in one process and with run_sharded over one worker
+    per entry of devices, and compares the time and the journals. Without a pipe a
+    StubPipe is used (a real pipeline must not be loaded before the workers fork).
+    """
+    pipe = pipe or StubPipe()
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+
+    outputs = {}
+    runs = (("Serial", annotate_in_batches), (f"{len(devices)} shards", partial(run_sharded, devices=devices)))
+    for name, annotate in runs:
+        store_path = os.path.join(work_directory, f"{name.replace(' ', '_')}.pkl")
+        experiment = make_experiment({commit['hash']: commit for commit in commits}, {})
+        _, elapsed = time_call(annotate, list(experiment.values()), 'llama_summary', generate_prompt_summarization_few_shots,
+                               ask_model_summarization_batch, pipe, store_path, batch_size, checkpoint_every)
+        with open(journal_path(store_path), encoding="utf-8") as file:
+            outputs[name] = file.read()
+        print(f"{name}: {elapsed:.2f}s")
+    print(f"Same journal: {len(set(outputs.values())) == 1}")
+
+
+
+def benchmark_sharded_resume(repo_path, pipe=None, devices=(-1, -1), n_commits=64, batch_size=8,
+                             work_directory='./sharded_resume_benchmark'):
+    """
+    Checks that the summary and category chains, sharing one store, resume a sharded run
+    killed midway to the outputs of a serial run: both chains first leave the journals of
+    part of every shard behind (a third of it for summaries, half for categories), as
+    killed workers would, then each is run with run_sharded.
+    """
+    pipe = pipe or StubPipe(0.001, 0.0001)
+    commits = list(extract_git_commits_streaming(repo_path, capture_policy=DEFAULT_CAPTURE_POLICY).values())[:n_commits]
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+    chains = (('llama_summary', generate_prompt_summarization_few_shots, ask_model_summarization_batch),
+              ('llama_category', generate_prompt_categorization_few_shots, ask_model_categorization_batch))
+
+    outputs = {}
+    for name in ("Serial", "Resumed"):
+        store_path = os.path.join(work_directory, f"{name}.pkl")
+        experiment_outputs = {}
+        experiment = make_experiment({commit['hash']: commit for commit in commits}, experiment_outputs)
+        save_commits(experiment_outputs, store_path)
+        if name == "Resumed":
+            interrupted = make_experiment({commit['hash']: commit for commit in commits}, {})
+            for k, (field, generate_prompt, ask_model_batch) in enumerate(chains):
+                for index in range(len(devices)):
+                    shard = [commit for commit in interrupted.values() if shard_of(commit['hash'], len(devices)) == index]
+                    annotate_in_batches(shard[:len(shard) // (3 - k)], field, generate_prompt, ask_model_batch, pipe,
+                                        shard_path(store_path, index, field), batch_size, batch_size)
+        annotate = annotate_in_batches if name == "Serial" else partial(run_sharded, devices=devices)
+        for field, generate_prompt, ask_model_batch in chains:
+            annotate(list(experiment.values()), field, generate_prompt, ask_model_batch, pipe, store_path, batch_size, batch_size)
+        outputs[name] = load_commits(store_path)
+    leftovers = [file_name for file_name in os.listdir(work_directory) if '_shard' in file_name]
+    print(f"Resumed sharded run, same outputs as a serial run: {outputs['Serial'] == outputs['Resumed']}, "
+          f"shard journals left: {len(leftovers)}")
+
+
+
+class FailingPipe(StubPipe):
+    """
+    StubPipe whose calls raise, like a model that cannot be loaded.
+    """
+
+    def __call__(self, prompts, **generate_kwargs):
+        raise OSError("Model could not be loaded")
+
+
+def benchmark_batch_failure(repo_path, work_directory='./batch_failure_benchmark', queue_size=16):
+    """
+    Checks that run_batch raises the model error instead of hanging when the model
+    fails while extraction threads are blocked on the full commits queue, and that no
+    watermark was moved.
+    """
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+    start = time.perf_counter()
+    try:
+        run_batch([repo_path, repo_path], FailingPipe(), work_directory, workers=2, queue_size=queue_size)
+        error = None
+    except OSError as raised:
+        error = raised
+    elapsed = time.perf_counter() - start
+    watermarks = load_commits(full_path(repo_output_directory(work_directory, repo_path), "watermarks"))
+    print(f"Model failure: raised {error!r} after {elapsed:.2f}s, watermarks saved: {watermarks is not None}")
+
+
+
+def benchmark_startup(repo_path, work_directory='./startup_benchmark'):
+    """
+    Times a no-op resume of main.py (every commit already annotated, tables already
+    built) next to the imports of torch and transformers it used to pay at startup.
+    """
+    work_directory = os.path.abspath(work_directory)
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    local_path = os.path.join(work_directory, 'mujs')
+    if os.path.exists(work_directory):
+        shutil.rmtree(work_directory)
+    os.makedirs(work_directory)
+    subprocess.run(['git', 'clone', '-q', os.path.abspath(repo_path), local_path], check=True)
+
+    # Stores of a finished run: every commit extracted and annotated
+    watermarks = {}
+    commits = key_commits_by_hash(extract_new_commits(local_path, watermarks, capture_policy=DEFAULT_CAPTURE_POLICY))
+    few_shots_outputs = {}
+    for commit in make_experiment(commits, few_shots_outputs).values():
+        commit['llama_summary'] = 'Summary'
+        commit['llama_category'] = 'Other'
+    save_commits(commits, os.path.join(work_directory, 'commits_raw.pkl'))
+    save_commits(few_shots_outputs, os.path.join(work_directory, 'commits_few_shots.pkl'))
+    save_commits(watermarks, os.path.join(work_directory, 'commits_watermarks.pkl'))
+
+    environment = dict(os.environ, MPLBACKEND='Agg')
+    def run_main():
+        subprocess.run([sys.executable, main_path], cwd=work_directory, env=environment, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    _, first_time = time_call(run_main)  # Builds the tables and plots once
+    _, resume_time = time_call(run_main)
+    _, import_time = time_call(subprocess.run, [sys.executable, '-c', 'import torch, transformers'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(f"First run (tables and plots): {first_time:.2f}s")
+    print(f"No-op resume:                 {resume_time:.2f}s")
+    print(f"import torch, transformers:   {import_time:.2f}s (plus the model load, no longer paid by a no-op resume)")
+
+
+if __name__ == "__main__":
+    # Usage: python benchmarks.py <repo_path> [n_commits]
+    REPO_PATH = sys.argv[1] if len(sys.argv) > 1 else './synthetic_repo'
+    N_COMMITS = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    if not os.path.isdir(REPO_PATH):
+        make_synthetic_repo(REPO_PATH, N_COMMITS)
+    benchmark_extraction(REPO_PATH)
+    benchmark_parallel_extraction(REPO_PATH)
+    benchmark_pipeline_memory(REPO_PATH)
+    benchmark_capture_policy(REPO_PATH)
+    benchmark_cat_file(REPO_PATH)
+    benchmark_checkpoints(REPO_PATH)
+    benchmark_experiment_memory(REPO_PATH)
+    benchmark_commit_record()
+    benchmark_diff_store(REPO_PATH)
+    benchmark_prompt_budget(REPO_PATH)
+    benchmark_startup(REPO_PATH)
+    benchmark_inference_server(REPO_PATH)
+    benchmark_staged_pipeline(REPO_PATH)
+    benchmark_sharded(REPO_PATH)
+    benchmark_sharded_resume(REPO_PATH)
+    benchmark_batch_failure(REPO_PATH)
+
+    try:
+        import torch
+        from transformers import pipeline
+    except ImportError:
+        print("torch/transformers not installed, skipping the inference benchmarks")
+    else:
+        DEVICE_USED = 0 if torch.cuda.is_available() else -1
+        PIPE_LLAMA = pipeline("text-generation", model="meta-llama/Llama-3.2-1B-Instruct", pad_token_id=128001, device=DEVICE_USED)
+        benchmark_batched_inference(REPO_PATH, PIPE_LLAMA)
+        benchmark_prefix_cache(REPO_PATH, PIPE_LLAMA)
+        benchmark_prefix_cache_batched(REPO_PATH, PIPE_LLAMA)
+        benchmark_category_scoring(REPO_PATH, PIPE_LLAMA)
+        benchmark_stopping(REPO_PATH, PIPE_LLAMA)
+        benchmark_response_cache(REPO_PATH, PIPE_LLAMA)
+        benchmark_inference_server(REPO_PATH, PIPE_LLAMA)
+        benchmark_prompt_lookup(REPO_PATH, PIPE_LLAMA)
+        benchmark_multi_task(REPO_PATH, PIPE_LLAMA)
+        benchmark_staged_pipeline(REPO_PATH, PIPE_LLAMA, n_commits=32)
+        benchmark_cpu_modes(REPO_PATH)
+        if DEVICE_USED != -1:
+            benchmark_prefix_cache(REPO_PATH, pipeline("text-generation", model="meta-llama/Llama-3.2-1B-Instruct", pad_token_id=128001, device=-1))
@@ -0,0 +1,192 @@
+import os, mmap, hashlib, threading
+from contextlib import contextmanager
+
+DIGEST_SIZE = 20
+LENGTH_SIZE = 8
+HEADER_SIZE = DIGEST_SIZE + LENGTH_SIZE
+
+# Stores opened in this process, so unpickled references reuse the same mapping
+_open_stores = {}
+# Directory store paths are pickled relative to (see pickled_in), per thread
+_pickle_directory = threading.local()
+# (directory, pickled path) -> store, so each unpickled reference does not resolve its path again
+_unpickled_stores = {}
+# (store path, directory) -> relative path, computed once per pickle rather than per reference
+_relative_paths = {}
+
+
+class DiffBlobStore:
+    """
+    Append-only, content-addressed file of diff texts.
+
+    Each entry is a 20-byte BLAKE2b digest of the UTF-8 text, its length and the text
+    itself, so identical diffs (cherry-picks, reverts, merges) are stored once. The
+    file is memory-mapped for reading and the digest -> offset index is rebuilt on
+    open by hopping over the entry headers, without reading the texts.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, 'a+b')
+        self.index = {}
+        self.written_bytes = 0
+        self.deduplicated_bytes = 0
+        self._map = None
+        self._mapped_size = 0
+        self._scan()
+        _open_stores[self.path] = self
+
+    def _scan(self):
+        self._remap()
+        position = 0
+        while position + HEADER_SIZE <= self._mapped_size:
+            digest = bytes(self._map[position:position + DIGEST_SIZE])
+            length = int.from_bytes(self._map[position + DIGEST_SIZE:position + HEADER_SIZE], 'little')
+            if position + HEADER_SIZE + length > self._mapped_size:
+                break  # Entry cut short by a killed run, it will be appended again
+            self.index[digest] = (position + HEADER_SIZE, length)
+            position += HEADER_SIZE + length
+        if position != self._mapped_size:
+            self.file.truncate(position)
+            self._remap()
+
+    def _remap(self):
+        self.file.flush()
+        size = os.path.getsize(self.path)
+        if size != self._mapped_size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            self._mapped_size = size
+
+    def put(self, text):
+        """
+        Stores a diff text if it is not there yet and returns a StoredDiff for it.
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+        if digest in self.index:
+            self.deduplicated_bytes += len(data)
+        else:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(digest + len(data).to_bytes(LENGTH_SIZE, 'little') + data)
+            self.index[digest] = (offset + HEADER_SIZE, len(data))
+            self.written_bytes += len(data)
+        return StoredDiff(self, digest)
+
+    def read(self, digest, max_chars=None):
+        """
+        Decodes a stored text, or only its first max_chars characters.
+        """
+        offset, length = self.index[digest]
+        if offset + length > self._mapped_size:
+            self._remap()
+        if max_chars is not None:
+            # A UTF-8 character is at most 4 bytes
+            length = min(length, 4 * max_chars)
+            return self._map[offset:offset + length].decode('utf-8', errors='ignore')[:max_chars]
+        return self._map[offset:offset + length].decode('utf-8')
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self.file.close()
+        _open_stores.pop(self.path, None)
+        for key in [key for key, store in _unpickled_stores.items() if store is self]:
+            del _unpickled_stores[key]
+
+
+def open_diff_store(path):
+    """
+    Returns the store at path, opening it once per process.
+    """
+    path = os.path.abspath(path)
+    return _open_stores.get(path) or DiffBlobStore(path)
+
+
+@contextmanager
+def pickled_in(directory):
+    """
+    Within the block, StoredDiff references are pickled with the path of their store
+    relative to directory, and relative paths are unpickled from it, so a pickle and
+    its store can be moved together. Absolute paths of older pickles still load.
+    """
+    previous = getattr(_pickle_directory, 'path', None)
+    _pickle_directory.path = os.path.abspath(directory)
+    try:
+        yield
+    finally:
+        _pickle_directory.path = previous
+
+
+def _load_stored_diff(path, digest):
+    directory = getattr(_pickle_directory, 'path', None)
+    store = _unpickled_stores.get((directory, path))
+    if store is None:
+        store = open_diff_store(os.path.join(directory, path) if directory else path)
+        _unpickled_stores[(directory, path)] = store
+    return StoredDiff(store, digest)
+
+
+class StoredDiff:
+    """
+    Reference to a diff text in a DiffBlobStore, used as a value of commit['diffs'].
+    Slicing from the start (diff[:1000], as the prompt builders do) decodes only the
+    bytes needed; anything else materializes the text. Pickles as the path of the
+    store (relative inside pickled_in) and the digest.
+    """
+
+    __slots__ = ('store', 'digest')
+
+    def __init__(self, store, digest):
+        self.store = store
+        self.digest = digest
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and not key.start and key.step in (None, 1) and key.stop is not None and key.stop >= 0:
+            return self.store.read(self.digest, max_chars=key.stop)
+        return str(self)[key]
+
+    def __str__(self):
+        return self.store.read(self.digest)
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def __len__(self):
+        return len(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, StoredDiff):
+            return self.digest == other.digest
+        return str(self) == other
+
+    def splitlines(self, keepends=False):
+        return str(self).splitlines(keepends)
+
+    def __reduce__(self):
+        directory = getattr(_pickle_directory, 'path', None)
+        path = self.store.path
+        if directory:
+            path = _relative_paths.get((path, directory)) or _relative_paths.setdefault(
+                (path, directory), os.path.relpath(path, directory))
+        return _load_stored_diff, (path, self.digest)
+
+    def __repr__(self):
+        return f"StoredDiff({self.digest.hex()[:12]})"
+
+
+def externalize_diffs(commits, store):
+    """
+    Moves the diff texts of every commit into store, leaving StoredDiff references
+    in commit['diffs']. Diffs already stored are left as they are.
+    """
+    for commit in commits.values():
+        commit['diffs'] = {file_name: diff if isinstance(diff, StoredDiff) else store.put(diff)
+                           for file_name, diff in commit['diffs'].items()}
+    store.file.flush()
+    return commits
@@ -1,5 +1,6 @@
 import re
 from utils import clean_text_paragraph
+from inference import generate_answers, generate_batched
 
 CATEGORIES = [
     "Feature Update",
@@ -153,18 +154,83 @@ def refine_answer(answer):
             return category
     return "Other"
 
+CATEGORIZATION_GENERATION = dict(
+    max_new_tokens=20,
+    do_sample=False,
+    temperature=None,  # Ensure deterministic output
+    top_p=1.0
+)
+
+def parse_categorization_answer(answer):
+    """
+    Keep only the category from the generated text.
+    """
+    answer = answer.split("Category:")[-1]
+    return refine_answer(answer)
+
 def ask_model_categorization(prompt, pipe):
     """
     Ask the model to categorize a git commit.
     """
-    answer = pipe(
-        prompt,
-        max_new_tokens=20,
-        do_sample=False,
-        temperature=None,  # Ensure deterministic output
-        top_p=1.0
-    )[0]['generated_text']
+    answer = generate_answers(pipe, prompt, 'categorization', **CATEGORIZATION_GENERATION)
+    return parse_categorization_answer(answer)
 
-    answer = answer.split("Category:")[-1]
-    return refine_answer(answer)
+def score_categories(prompt, pipe, categories=CATEGORIES):
+    """
+    Score every category as the continuation of the prompt instead of generating one.
+    The prompt is prefilled once, its key/values are repeated for each category and all
+    the labels go through the model in a single batched forward pass.
+    Returns the probability of each category (softmax of the label log-likelihoods).
+    """
+    import torch
+
+    model, tokenizer = pipe.model, pipe.tokenizer
+    prompt_ids = tokenizer(prompt, return_tensors='pt').input_ids.to(model.device)
+    label_ids = [tokenizer(f" {category}", add_special_tokens=False).input_ids for category in categories]
+    n_prompt = prompt_ids.shape[1]
+    n_label = max(len(ids) for ids in label_ids)
+
+    labels = torch.zeros((len(categories), n_label), dtype=torch.long, device=model.device)
+    label_mask = torch.zeros((len(categories), n_label), dtype=torch.long, device=model.device)
+    for i, ids in enumerate(label_ids):
+        labels[i, :len(ids)] = torch.tensor(ids)
+        label_mask[i, :len(ids)] = 1
+
+    with torch.no_grad():
+        prefill = model(prompt_ids, use_cache=True)
+        cache = prefill.past_key_values
+        cache.batch_repeat_interleave(len(categories))
+        attention_mask = torch.cat([torch.ones((len(categories), n_prompt), dtype=torch.long, device=model.device), label_mask], dim=1)
+        position_ids = torch.arange(n_prompt, n_prompt + n_label, device=model.device).expand(len(categories), -1)
+        logits = model(labels, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache).logits
+
+    # Token j of a label is predicted by the logits of the previous position
+    logits = torch.cat([prefill.logits[:, -1:].expand(len(categories), -1, -1), logits[:, :-1]], dim=1)
+    token_log_probs = torch.log_softmax(logits.float(), dim=-1).gather(2, labels.unsqueeze(-1)).squeeze(-1)
+    log_likelihoods = (token_log_probs * label_mask).sum(dim=1)
+    probabilities = torch.softmax(log_likelihoods, dim=0).tolist()
+    return dict(zip(categories, probabilities))
+
+def ask_model_categorization_scored(prompt, pipe):
+    """
+    Ask the model to categorize a git commit by scoring the categories.
+    Returns the most likely category and the probability of each one.
+    """
+    confidences = score_categories(prompt, pipe)
+    return max(confidences, key=confidences.get), confidences
+
+def ask_model_categorization_scored_batch(prompts, pipe, batch_size=None):
+    """
+    Scored categorization of several git commits, each in its own forward pass
+    (batch_size is accepted for compatibility with ask_model_categorization_batch).
+    """
+    return [ask_model_categorization_scored(prompt, pipe) for prompt in prompts]
+
+def ask_model_categorization_batch(prompts, pipe, batch_size=8):
+    """
+    Ask the model to categorize several git commits, in length-sorted batches.
+    Categories are returned in the order of prompts.
+    """
+    answers = generate_batched(prompts, pipe, batch_size, 'categorization', **CATEGORIZATION_GENERATION)
+    return [parse_categorization_answer(answer) for answer in answers]
 
@@ -0,0 +1,67 @@
+import sys
+from collections.abc import MutableMapping
+
+
+class Commit(MutableMapping):
+    """
+    Compact record for one commit, used in place of a plain dict.
+
+    The known fields live in __slots__, the author and every file path are interned
+    so repeated strings are stored once, and any other key (e.g. the outputs the
+    notebook adds on the fly) goes to a side dict created on first use.
+    It behaves like the commit dicts it replaces, so commit['diffs'], `in`, .get(),
+    .items() and pickling keep working.
+    """
+
+    FIELDS = ('hash', 'author', 'date', 'message', 'files', 'diffs',
+              'llama_summary', 'llama_category', 'llama_tech_summary',
+              'diff_lines', 'skipped_files')
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, fields=(), **kwargs):
+        self.update(fields, **kwargs)
+
+    def __getitem__(self, key):
+        try:
+            if key in Commit.FIELDS:
+                return getattr(self, key)
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key == 'author':
+            value = sys.intern(value)
+        elif key == 'files':
+            value = [sys.intern(path) for path in value]
+        elif key in ('diffs', 'diff_lines', 'skipped_files'):
+            value = {sys.intern(file_name): item for file_name, item in value.items()}
+
+        if key in Commit.FIELDS:
+            setattr(self, key, value)
+        else:
+            try:
+                self._extra[key] = value
+            except AttributeError:
+                self._extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in Commit.FIELDS:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        for key in Commit.FIELDS:
+            if hasattr(self, key):
+                yield key
+        yield from getattr(self, '_extra', ())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Commit({dict(self)!r})"
@@ -0,0 +1,149 @@
+import difflib, subprocess
+from collections import OrderedDict
+
+
+class CatFileBatch:
+    """
+    Long-lived `git cat-file --batch` / `--batch-check` coprocesses shared by all
+    object reads of a repository, with an LRU cache of recently read objects.
+    """
+
+    def __init__(self, repo_path, cache_bytes=64 * 2**20):
+        self.repo_path = repo_path
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._batch = None
+        self._batch_check = None
+
+    def _start(self, mode):
+        return subprocess.Popen(['git', '-C', self.repo_path, 'cat-file', mode],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _request(self, process, object_name):
+        process.stdin.write(f"{object_name}\n".encode('utf-8'))
+        process.stdin.flush()
+        header = process.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:  # "<name> missing"
+            raise KeyError(object_name)
+        return header
+
+    def info(self, object_name):
+        """
+        Returns (sha, type, size) of an object without reading its content.
+        """
+        if self._batch_check is None:
+            self._batch_check = self._start('--batch-check')
+        sha, object_type, size = self._request(self._batch_check, object_name)
+        return sha, object_type, int(size)
+
+    def read(self, sha):
+        """
+        Returns (type, content bytes) of an object, from the cache when possible.
+        """
+        if sha in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(sha)
+            return self.cache[sha]
+
+        self.misses += 1
+        if self._batch is None:
+            self._batch = self._start('--batch')
+        _, object_type, size = self._request(self._batch, sha)
+        content = self._batch.stdout.read(int(size))
+        self._batch.stdout.read(1)  # Trailing newline after the content
+
+        self.cache[sha] = (object_type, content)
+        self.cached_bytes += len(content)
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, (_, evicted) = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+        return object_type, content
+
+    def close(self):
+        for process in (self._batch, self._batch_check):
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+                process.stdout.close()
+        self._batch = self._batch_check = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_tree(objects, sha):
+    """
+    Parses a tree object into a dict name -> (mode, sha).
+    """
+    _, content = objects.read(sha)
+    entries = {}
+    position = 0
+    while position < len(content):
+        space = content.index(b' ', position)
+        nul = content.index(b'\0', space)
+        mode = content[position:space].decode('ascii')
+        name = content[space + 1:nul].decode('utf-8', errors='replace')
+        entries[name] = (mode, content[nul + 1:nul + 21].hex())
+        position = nul + 21
+    return entries
+
+
+def diff_trees(objects, a_tree, b_tree, prefix=''):
+    """
+    Lists the blobs that differ between two trees as (path, a_sha, b_sha), where a
+    missing side is None. Identical subtrees are skipped without being read.
+    b_tree may be None (empty tree).
+    """
+    a_entries = read_tree(objects, a_tree) if a_tree else {}
+    b_entries = read_tree(objects, b_tree) if b_tree else {}
+    changes = []
+
+    for name in sorted(a_entries.keys() | b_entries.keys()):
+        a_mode, a_sha = a_entries.get(name, (None, None))
+        b_mode, b_sha = b_entries.get(name, (None, None))
+        if (a_mode, a_sha) == (b_mode, b_sha):
+            continue
+        path = f"{prefix}{name}"
+        a_is_tree = a_mode == '40000'
+        b_is_tree = b_mode == '40000'
+        if a_is_tree or b_is_tree:
+            changes.extend(diff_trees(objects, a_sha if a_is_tree else None, b_sha if b_is_tree else None, f"{path}/"))
+        if (a_mode is not None and not a_is_tree) or (b_mode is not None and not b_is_tree):
+            changes.append((path, None if a_is_tree else a_sha, None if b_is_tree else b_sha))
+
+    return sorted(changes)
+
+
+def read_blob_text(objects, sha):
+    """
+    Returns the text of a blob, or None if it looks binary (NUL in the first 8000
+    bytes, like git) or is not a blob (e.g. a submodule commit).
+    """
+    if sha is None:
+        return ''
+    try:
+        object_type, content = objects.read(sha)
+    except KeyError:
+        return None
+    if object_type != 'blob' or b'\0' in content[:8000]:
+        return None
+    return content.decode('utf-8', errors='replace')
+
+
+def diff_blobs(objects, a_sha, b_sha):
+    """
+    Returns a zero-context unified diff between two blobs, or None if either is binary.
+    The diff is difflib's: hunks can pair the changed lines differently than git's diff
+    algorithm, so it is not byte-identical to the one of `git log -p`.
+    """
+    a_text = read_blob_text(objects, a_sha)
+    b_text = read_blob_text(objects, b_sha)
+    if a_text is None or b_text is None:
+        return None
+    return '\n'.join(difflib.unified_diff(a_text.splitlines(), b_text.splitlines(), n=0, lineterm=''))
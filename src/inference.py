@@ -0,0 +1,297 @@
+import time, queue, threading
+from tqdm import tqdm
+from utils import save_commit_fields
+from stopping import TASK_STOPS, StopWhenAnswerComplete, trim_answer, record_generation
+
+# Per stage of annotate_staged: commits handled, seconds busy, waiting for input, blocked
+# on a full output queue, and wall time of the runs it was part of
+STAGE_STATS = {}
+
+
+class LazyPipeline:
+    """
+    Stands in for the text-generation pipeline and only builds it with factory (which
+    imports torch and transformers and loads the model) on the first call or attribute
+    access, i.e. when a commit actually needs the model. Threads asking for it at the
+    same time wait for a single load.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._pipe = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._pipe is not None
+
+    def _load(self):
+        if self._pipe is None:
+            with self._lock:
+                if self._pipe is None:
+                    self._pipe = self._factory()
+        return self._pipe
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+def cpu_supports_bf16():
+    """
+    Whether the CPU computes in bfloat16 natively (AVX512-BF16 or AMX); elsewhere
+    bfloat16 is emulated and slower than float32.
+    """
+    import torch
+    checks = [getattr(torch.cpu, name, None) for name in ('_is_avx512_bf16_supported', '_is_amx_tile_supported')]
+    return any(check() for check in checks if check is not None)
+
+
+def optimize_for_cpu(pipe, mode='fp32', threads=None):
+    """
+    Prepares a pipeline running on the CPU: threads sets the intra-op thread count
+    (physical cores usually work best), mode 'bf16' casts the weights to bfloat16 when
+    the CPU supports it and 'int8' swaps the Linear layers for dynamically quantized
+    int8 ones (weights quantized once, activations on the fly). 'fp32' keeps the model as is.
+    """
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    if mode == 'bf16':
+        if cpu_supports_bf16():
+            pipe.model.to(torch.bfloat16)
+        else:
+            print("bfloat16 is not supported natively by this CPU, keeping float32")
+    elif mode == 'int8':
+        from torch.ao.quantization import quantize_dynamic
+        quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif mode != 'fp32':
+        raise ValueError(f"Unknown CPU mode {mode!r}, expected 'fp32', 'bf16' or 'int8'")
+    return pipe
+
+
+def prepare_pipe_for_batching(pipe, padding_side='left'):
+    """
+    Lets a text-generation pipeline pad batches: decoder-only models are padded on the
+    left so every prompt ends right where generation starts. Llama has no pad token,
+    the end-of-sequence token is used instead (padding is masked out anyway).
+    """
+    tokenizer = getattr(pipe, 'tokenizer', None)
+    if tokenizer is not None:
+        tokenizer.padding_side = padding_side
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+    return pipe
+
+
+def length_buckets(prompts, batch_size):
+    """
+    Splits prompt indices into batches of prompts of similar length, longest first,
+    so each batch is padded to about the length of its own prompts and the
+    out-of-memory case, if any, shows up on the first batch.
+    Character length is used as a cheap proxy for the token count.
+    """
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]), reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def generate_answers(pipe, prompts, task=None, **generate_kwargs):
+    """
+    Runs a prompt, or a list of prompts as one batch, through the pipeline and returns
+    only the generated text (without the prompt). With a task from TASK_STOPS,
+    generation ends as soon as the answer is complete and the answer is cut at the
+    task's stop strings; the tokens saved are added to GENERATION_STATS.
+
+    prompt_lookup_num_tokens (a generate setting) turns on prompt lookup decoding: up to
+    that many tokens are drafted by matching the last tokens against the prompt and are
+    verified in one forward pass, which greedy outputs do not change. It only runs one
+    prompt at a time, a list is then answered prompt by prompt, as it is for pipes that
+    run prompts one at a time (batches_prompts false, e.g. PrefixCachedPipe), so each
+    prompt gets its own stopping criteria.
+    """
+    prompt_lookup = generate_kwargs.pop('prompt_lookup_num_tokens', None)
+    if prompt_lookup:
+        generate_kwargs['prompt_lookup_num_tokens'] = prompt_lookup
+    if not isinstance(prompts, str) and (prompt_lookup or not getattr(pipe, 'batches_prompts', True)):
+        generate_kwargs.pop('batch_size', None)
+        return [generate_answers(pipe, prompt, task, **generate_kwargs) for prompt in prompts]
+
+    tokenizer = getattr(pipe, 'tokenizer', None)
+    criteria = None
+    if task is not None and tokenizer is not None:
+        from transformers import StoppingCriteriaList
+        # Prompt lookup may accept several tokens in its first step, the prompt length is counted here
+        prompt_length = len(tokenizer(prompts).input_ids) if prompt_lookup else None
+        criteria = StopWhenAnswerComplete(tokenizer, task=task, prompt_length=prompt_length, **TASK_STOPS[task])
+        generate_kwargs['stopping_criteria'] = StoppingCriteriaList([criteria])
+
+    outputs = pipe(prompts, return_full_text=False, **generate_kwargs)
+    if isinstance(prompts, str):
+        answers = [outputs[0]['generated_text']]
+    else:
+        answers = [output[0]['generated_text'] for output in outputs]
+
+    if task is not None:
+        answers = [trim_answer(answer, task) for answer in answers]
+    if criteria is not None and criteria.length is not None:
+        record_generation(task, criteria, generate_kwargs.get('max_new_tokens', 20))
+    return answers[0] if isinstance(prompts, str) else answers
+
+
+def generate_batched(prompts, pipe, batch_size=8, task=None, **generate_kwargs):
+    """
+    Runs prompts through the pipeline in length-sorted batches and returns the
+    generated texts in the order of prompts.
+    """
+    if batch_size > 1:
+        prepare_pipe_for_batching(pipe)
+    answers = [None] * len(prompts)
+    for bucket in length_buckets(prompts, batch_size):
+        outputs = generate_answers(pipe, [prompts[i] for i in bucket], task, batch_size=len(bucket), **generate_kwargs)
+        for i, answer in zip(bucket, outputs):
+            answers[i] = answer
+    return answers
+
+
+def annotate_in_batches(commits, field, generate_prompt, ask_model_batch, pipe, store_path,
+                        batch_size=8, checkpoint_every=64):
+    """
+    Fills `field` on every commit of the list with the batched model call, journaling
+    the results after each group of `checkpoint_every` commits so an interrupted run
+    loses at most one group. field may be a tuple of fields, in which case
+    ask_model_batch returns one tuple of values per commit.
+    """
+    fields = field if isinstance(field, tuple) else (field,)
+    with tqdm(total=len(commits), desc=', '.join(fields)) as progress:
+        for start in range(0, len(commits), checkpoint_every):
+            group = commits[start:start + checkpoint_every]
+            answers = ask_model_batch([generate_prompt(commit) for commit in group], pipe, batch_size)
+            for commit, answer in zip(group, answers):
+                for name, value in zip(fields, answer if isinstance(field, tuple) else (answer,)):
+                    commit[name] = value
+                save_commit_fields(commit, list(fields), store_path)
+            progress.update(len(group))
+    return commits
+
+
+def record_stage(stage, **seconds):
+    stats = STAGE_STATS.setdefault(stage, {'commits': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0, 'wall': 0.0})
+    for name, value in seconds.items():
+        stats[name] += value
+    return stats
+
+
+def _put(items, item, consuming):
+    """
+    Puts item in a bounded queue, waiting while it is full as long as consuming() is
+    true. Returns the seconds waited and whether the item was put.
+    """
+    start = time.perf_counter()
+    while consuming():
+        try:
+            items.put(item, timeout=0.1)
+            return time.perf_counter() - start, True
+        except queue.Full:
+            continue
+    return time.perf_counter() - start, False
+
+
+def _get(items):
+    start = time.perf_counter()
+    item = items.get()
+    return time.perf_counter() - start, item
+
+
+def annotate_staged(commits, field, generate_prompt, ask_model_batch, pipe, store_path,
+                    batch_size=8, checkpoint_every=64, queue_size=2):
+    """
+    Same groups, model calls and journal as annotate_in_batches, run as three stages
+    connected by bounded queues: a thread builds the prompts of the next groups and
+    another journals the answers of the previous group while the calling thread runs
+    the model. At most queue_size groups wait between two stages, so a slow stage
+    holds the others back instead of piling up prompts or answers in memory. The time
+    each stage spends working, waiting for input and blocked on its output is added
+    to STAGE_STATS (see print_stage_stats). An error in any stage stops the others
+    and is raised once the answers already computed are journaled.
+    """
+    fields = field if isinstance(field, tuple) else (field,)
+    groups = [commits[start:start + checkpoint_every] for start in range(0, len(commits), checkpoint_every)]
+    prompts_queue = queue.Queue(maxsize=queue_size)
+    answers_queue = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()  # Set when inference stops early
+    errors = []
+
+    def build_prompts():
+        try:
+            for group in groups:
+                start = time.perf_counter()
+                prompts = [generate_prompt(commit) for commit in group]
+                busy = time.perf_counter() - start
+                blocked, put = _put(prompts_queue, (group, prompts), lambda: not stopped.is_set())
+                record_stage('prompts', commits=len(group), busy=busy, blocked=blocked)
+                if not put:
+                    return
+        except BaseException as error:
+            errors.append(error)
+        finally:
+            _put(prompts_queue, None, lambda: not stopped.is_set())
+
+    def persist(progress):
+        try:
+            while True:
+                starved, item = _get(answers_queue)
+                if item is None:
+                    record_stage('persist', starved=starved)
+                    return
+                group, answers = item
+                start = time.perf_counter()
+                for commit, answer in zip(group, answers):
+                    for name, value in zip(fields, answer if isinstance(field, tuple) else (answer,)):
+                        commit[name] = value
+                    save_commit_fields(commit, list(fields), store_path)
+                progress.update(len(group))
+                record_stage('persist', commits=len(group), busy=time.perf_counter() - start, starved=starved)
+        except BaseException as error:
+            errors.append(error)
+
+    wall_start = time.perf_counter()
+    with tqdm(total=len(commits), desc=', '.join(fields)) as progress:
+        builder = threading.Thread(target=build_prompts, name='prompt-builder', daemon=True)
+        persister = threading.Thread(target=persist, args=(progress,), name='persister', daemon=True)
+        builder.start()
+        persister.start()
+        try:
+            while True:
+                starved, item = _get(prompts_queue)
+                if item is None:
+                    record_stage('inference', starved=starved)
+                    break
+                group, prompts = item
+                start = time.perf_counter()
+                answers = ask_model_batch(prompts, pipe, batch_size)
+                busy = time.perf_counter() - start
+                blocked, put = _put(answers_queue, (group, answers), persister.is_alive)
+                record_stage('inference', commits=len(group), busy=busy, starved=starved, blocked=blocked)
+                if not put:
+                    break
+        finally:
+            stopped.set()
+            _put(answers_queue, None, persister.is_alive)
+            builder.join()
+            persister.join()
+
+    wall = time.perf_counter() - wall_start
+    for stage in ('prompts', 'inference', 'persist'):
+        record_stage(stage, wall=wall)
+    if errors:
+        raise errors[0]
+    return commits
+
+
+def print_stage_stats():
+    for stage, stats in STAGE_STATS.items():
+        wall = max(stats['wall'], 1e-9)
+        print(f"{stage}: {stats['commits']} commits, busy {stats['busy']:.1f}s ({stats['busy'] / wall:.0%} of {stats['wall']:.1f}s), "
+              f"waiting for input {stats['starved']:.1f}s, blocked on output {stats['blocked']:.1f}s")
@@ -0,0 +1,181 @@
+import json, time, queue, threading
+from concurrent.futures import Future
+
+
+# Settings that do not change greedy outputs, ignored when merging requests with do_sample=False
+SAMPLING_SETTINGS = ('temperature', 'top_p', 'top_k')
+
+
+class _Request:
+    __slots__ = ('prompts', 'single', 'generate_kwargs', 'future')
+
+    def __init__(self, prompts, generate_kwargs):
+        self.single = isinstance(prompts, str)
+        self.prompts = [prompts] if self.single else list(prompts)
+        self.generate_kwargs = generate_kwargs
+        self.future = Future()
+
+    def settings_key(self):
+        ignored = ('max_new_tokens', 'stopping_criteria')
+        if not self.generate_kwargs.get('do_sample', False):
+            ignored += SAMPLING_SETTINGS
+        settings = {name: value for name, value in self.generate_kwargs.items() if name not in ignored}
+        return json.dumps(settings, sort_keys=True, default=str)
+
+
+class _MergedStoppingCriteria:
+    """
+    Applies to each request of a merged batch its own stopping criteria and token limit,
+    on its own rows only, so requests with different tasks and lengths can share a batch.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts  # (first row, last row + 1, max_new_tokens, stopping criteria)
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+        n_generated = input_ids.shape[1] - self.prompt_length
+        done = input_ids.new_zeros(input_ids.shape[0]).bool()
+        for start, end, max_new_tokens, criteria in self.parts:
+            if n_generated >= max_new_tokens:
+                done[start:end] = True
+                continue
+            for criterion in criteria:
+                done[start:end] |= criterion(input_ids[start:end], None if scores is None else scores[start:end])
+        return done
+
+
+class InferenceServer:
+    """
+    In-process inference service shared by every chain. Calls from any thread are queued
+    as requests and a worker thread merges the requests that arrive within max_wait
+    seconds of each other (up to max_batch_size prompts) into one model call, then
+    resolves their futures. Requests are merged when their generation settings match
+    (greedy ones whatever their sampling settings); each keeps its own max_new_tokens
+    and stopping criteria. Pipes that run prompts one at a time (batches_prompts false)
+    get one request per call instead.
+
+    The server can be passed wherever a pipeline is expected, so the ask_model_*
+    functions become thin clients of it; submit() returns the future instead of waiting.
+    """
+
+    def __init__(self, pipe, max_batch_size=8, max_wait=0.02):
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_prompts = 0
+        self.worker = threading.Thread(target=self._serve, name='inference-server', daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def submit(self, prompts, **generate_kwargs):
+        """
+        Queues a prompt (or a list of prompts answered together) and returns a Future
+        of the pipeline output for it.
+        """
+        generate_kwargs.pop('batch_size', None)
+        request = _Request(prompts, generate_kwargs)
+        self.requests.put(request)
+        return request.future
+
+    def __call__(self, prompts, **generate_kwargs):
+        return self.submit(prompts, **generate_kwargs).result()
+
+    def print_stats(self):
+        print(f"Inference server: {self.batched_prompts} prompts in {self.batches} model calls "
+              f"({self.batched_prompts / max(self.batches, 1):.1f} per call)")
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _collect(self, first):
+        """
+        Returns the requests arriving within max_wait of the first one, and whether the
+        server was closed meanwhile.
+        """
+        batch = [first]
+        n_prompts = len(first.prompts)
+        deadline = time.monotonic() + self.max_wait
+        while n_prompts < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+            n_prompts += len(request.prompts)
+        return batch, False
+
+    def _serve(self):
+        closed = False
+        while not closed:
+            first = self.requests.get()
+            if first is None:
+                break
+            batch, closed = self._collect(first)
+
+            groups = {}
+            for request in batch:
+                if request.generate_kwargs.get('prompt_lookup_num_tokens'):  # Only runs one prompt at a time
+                    groups[id(request)] = [request]
+                else:
+                    groups.setdefault(request.settings_key(), []).append(request)
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, group):
+        prompts = []
+        parts = []
+        for request in group:
+            max_new_tokens = request.generate_kwargs.get('max_new_tokens', 20)
+            criteria = list(request.generate_kwargs.get('stopping_criteria') or ())
+            parts.append((len(prompts), len(prompts) + len(request.prompts), max_new_tokens, criteria))
+            prompts.extend(request.prompts)
+
+        generate_kwargs = {name: value for name, value in group[0].generate_kwargs.items() if name != 'stopping_criteria'}
+        generate_kwargs['max_new_tokens'] = max(part[2] for part in parts)
+        # Everything touching the pipe can fail (a LazyPipeline loads here), the futures must not wait forever
+        try:
+            if len(group) > 1 and not getattr(self.pipe, 'batches_prompts', True):
+                # The pipe runs prompts one at a time (e.g. PrefixCachedPipe), the merged criteria's rows would not match
+                for request in group:
+                    self._run([request])
+                return
+            if len(group) > 1 or parts[0][3]:
+                merged = [_MergedStoppingCriteria(parts)]
+                if getattr(self.pipe, 'tokenizer', None) is not None:
+                    from transformers import StoppingCriteriaList
+                    merged = StoppingCriteriaList(merged)
+                generate_kwargs['stopping_criteria'] = merged
+            if len(prompts) > 1:
+                from inference import prepare_pipe_for_batching
+                prepare_pipe_for_batching(self.pipe)
+                generate_kwargs['batch_size'] = len(prompts)
+
+            outputs = self.pipe(prompts if len(prompts) > 1 else prompts[0], **generate_kwargs)
+            if len(prompts) == 1:
+                outputs = [outputs]
+        except Exception as error:
+            for request in group:
+                request.future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.batched_prompts += len(prompts)
+        for request, (start, end, _, _) in zip(group, parts):
+            result = outputs[start:end]
+            request.future.set_result(result[0] if request.single else result)
@@ -1,82 +1,242 @@
 import os
-import torch
-import copy
+import subprocess
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from transformers import pipeline
-from utils import load_commits, save_commits, full_path
-from utils import extract_git_commits, filter_trivial_commits, normalize_commit_data
+from utils import load_commits, save_commits, save_commit_fields, full_path
+from utils import extract_new_commits, key_commits_by_hash, merge_commits, DEFAULT_CAPTURE_POLICY
+from utils import make_experiment, load_experiment_outputs
 from utils import plot_categories, plot_categories_piechart
-from categorization import ask_model_categorization, generate_prompt_categorization_few_shots, generate_prompt_categorization_zero_shot
-from summary import ask_model_summarization, generate_prompt_summarization_few_shots, generate_prompt_summarization
-from tech_summary import generate_technical_report
+from analytics import build_commit_table, save_commit_table
+from blob_store import open_diff_store, externalize_diffs
+from inference import annotate_in_batches, annotate_staged, print_stage_stats, optimize_for_cpu, LazyPipeline
+from inference_server import InferenceServer
+from sharded import run_sharded
+from multi_task import MultiTaskPipe, MULTI_TASK_HEADS, annotate_multi_task
+from prefix_cache import PrefixCachedPipe, static_prefix
+from stopping import print_generation_stats
+from prompt_budget import budgeted, print_budget_stats
+from response_cache import ResponseCache, CachedPipe
+from categorization import ask_model_categorization_batch, ask_model_categorization_scored_batch, generate_prompt_categorization_few_shots, generate_prompt_categorization_zero_shot
+from summary import ask_model_summarization_batch, generate_prompt_summarization_few_shots, generate_prompt_summarization
+from tech_summary import generate_technical_report, generate_prompt_technical_analysis
 
 #from huggingface_hub import login
 #login() # Add Hugging Face token
 
-DEVICE_USED = 0 if torch.cuda.is_available() else -1
 REMOTE_PATH = 'https://github.com/ccxvii/mujs.git'
 LOCAL_PATH = './mujs'
+BRANCH = 'master'
+PULL_ON_START = False  # Fetch new upstream commits before extracting (needs the network)
+EXTRACTION_WORKERS = 1  # Set > 1 to extract, filter and normalize commits over a process pool
+INFERENCE_BATCH_SIZE = 8  # Prompts per forward pass, 1 runs the prompts one at a time
+CHECKPOINT_EVERY = 64  # Commits annotated between two journal writes
+EXTERNALIZE_DIFFS = False  # Keep diff texts in a deduplicated blob file: smaller pickle, slower load when diffs are small or unique
+CATEGORIZATION_MODE = 'generate'  # 'score' ranks the categories in one forward pass and also stores their probabilities
+CPU_MODE = 'fp32'  # Without CUDA: 'bf16' or 'int8' (dynamic quantization) trade accuracy for speed, see benchmarks.benchmark_cpu_modes
+CPU_THREADS = None  # Intra-op threads on the CPU, None keeps the torch default
+PROMPT_LOOKUP_NUM_TOKENS = None  # e.g. 10: draft summary tokens from the prompt (same greedy output, prompts run one at a time)
+USE_PROMPT_BUDGET = True  # Fit the diffs of large commits in the token budgets of prompt_budget.PROMPT_TOKEN_BUDGETS
+USE_RESPONSE_CACHE = True  # Answer deterministic calls already made with the same prompt and settings from disk
+RESPONSE_CACHE_MAX_BYTES = 256 * 2**20
+USE_INFERENCE_SERVER = False  # Run the chains concurrently against one worker merging their requests into batches
+INFERENCE_SERVER_MAX_WAIT = 0.02  # Seconds the server waits for other requests to join a batch
+USE_STAGED_PIPELINE = False  # Build prompts and journal answers in their own threads while the model runs
+STAGE_QUEUE_SIZE = 2  # Groups of CHECKPOINT_EVERY commits waiting between two stages
+SHARD_DEVICES = None  # e.g. [0, 1] or [-1, -1]: annotate in one forked worker per device (-1: CPU cores split between workers)
+USE_MULTI_TASK = False  # Prefill each commit once for its category, summary and technical analysis (own prompt layout)
+USE_PREFIX_CACHE = False  # Prefill the static part of the few-shot prompts once, prompts then run one at a time
+REPLOT = False  # Rebuild the tables and plots even when no output changed
 CURRENT_DIRECTORY = os.getcwd()
-PIPE_LLAMA = pipeline("text-generation", model="meta-llama/Llama-3.2-1B-Instruct", pad_token_id=128001, device=DEVICE_USED)
+# Templates whose static prefix is cached, taken before they are wrapped by the prompt budget
+PREFIX_CACHE_TEMPLATES = (generate_prompt_categorization_few_shots, generate_prompt_summarization_few_shots,
+                          generate_prompt_categorization_zero_shot, generate_prompt_technical_analysis)
+if SHARD_DEVICES:  # Forked workers load their own model, they cannot share the server thread or the cache connection
+    USE_INFERENCE_SERVER = USE_RESPONSE_CACHE = False
+WORKER_DEVICE = None  # Set in each sharded worker
+
+
+def load_pipeline():
+    """
+    Builds the model pipeline; torch and transformers are only imported here, on the
+    first commit that needs the model, so runs with nothing to process start fast.
+    """
+    from transformers import pipeline
+
+    device_used = pipeline_device()
+    pipe = pipeline("text-generation", model="meta-llama/Llama-3.2-1B-Instruct", pad_token_id=128001, device=device_used)
+    if device_used == -1:
+        optimize_for_cpu(pipe, CPU_MODE, CPU_THREADS)
+    if USE_PREFIX_CACHE:
+        pipe = PrefixCachedPipe(pipe, [static_prefix(generate_prompt) for generate_prompt in PREFIX_CACHE_TEMPLATES])
+    return pipe
+
+
+def pipeline_device():
+    """
+    Device the pipeline is loaded on: the sharded worker's, else the GPU when there is one (-1: CPU).
+    """
+    import torch
+    if WORKER_DEVICE is not None:
+        return WORKER_DEVICE
+    return 0 if torch.cuda.is_available() else -1
+
+
+def response_cache_model_id():
+    """
+    Model id of the cached answers. bf16 and int8 answers can differ from fp32 ones, they
+    are cached apart; CPU_MODE only applies on the CPU and fp32 keeps the plain id.
+    """
+    model_id = "meta-llama/Llama-3.2-1B-Instruct"
+    if CPU_MODE == 'fp32' or pipeline_device() != -1:
+        return model_id
+    return f"{model_id}:{CPU_MODE}"
+
+
+def use_worker_device(device):
+    global WORKER_DEVICE
+    WORKER_DEVICE = device
+
+
+PIPE_LLAMA = LazyPipeline(load_pipeline)
+if USE_STAGED_PIPELINE:
+    annotate_in_batches = partial(annotate_staged, queue_size=STAGE_QUEUE_SIZE)
+if SHARD_DEVICES:
+    annotate_in_batches = partial(run_sharded, devices=SHARD_DEVICES, setup_worker=use_worker_device, annotate=annotate_in_batches)
+if USE_INFERENCE_SERVER:
+    INFERENCE_SERVER = PIPE_LLAMA = InferenceServer(PIPE_LLAMA, 2 * INFERENCE_BATCH_SIZE, INFERENCE_SERVER_MAX_WAIT)
+if USE_PROMPT_BUDGET:
+    generate_prompt_categorization_few_shots = budgeted(generate_prompt_categorization_few_shots, 'categorization', PIPE_LLAMA)
+    generate_prompt_categorization_zero_shot = budgeted(generate_prompt_categorization_zero_shot, 'categorization', PIPE_LLAMA)
+    generate_prompt_summarization_few_shots = budgeted(generate_prompt_summarization_few_shots, 'summarization', PIPE_LLAMA)
+    generate_prompt_technical_analysis = budgeted(generate_prompt_technical_analysis, 'technical_analysis', PIPE_LLAMA)
+if USE_RESPONSE_CACHE:
+    RESPONSE_CACHE = ResponseCache(os.path.join(CURRENT_DIRECTORY, "llm_responses.sqlite"), RESPONSE_CACHE_MAX_BYTES)
+    # Resolved on the first prompt, finding the device imports torch
+    PIPE_LLAMA = CachedPipe(PIPE_LLAMA, RESPONSE_CACHE, model_id=response_cache_model_id)
 
 # Avoid warning related to parallelization
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 if not os.path.isdir(LOCAL_PATH):
-    os.system(f"git clone {REMOTE_PATH} {LOCAL_PATH}")
+    subprocess.run(['git', 'clone', REMOTE_PATH, LOCAL_PATH], check=False)
+elif PULL_ON_START:
+    subprocess.run(['git', '-C', LOCAL_PATH, 'pull', '-q', '--ff-only'], check=False)
 
 DATA_FILEPATH_RAW_DATA = 'commits_raw.pkl'
 DATA_FILEPATH_ZERO_SHOT = 'commits_zero_shot.pkl'
 DATA_FILEPATH_FEW_SHOTS = 'commits_few_shots.pkl'
-
-commits = load_commits(DATA_FILEPATH_RAW_DATA)  # To resume experiments
-commits_zero_shot = load_commits(DATA_FILEPATH_ZERO_SHOT)  # To resume experiments
-commits_few_shots = load_commits(DATA_FILEPATH_FEW_SHOTS)  # To resume experiments
-
-if commits is None:  # If there are no checkpoints, initialize commits extraction
-    commits = extract_git_commits(LOCAL_PATH)  # Extract commits from repository
-    commits = filter_trivial_commits(commits)  # Filter trivial commits
-    commits = normalize_commit_data(commits)  # Normalize commits
-    commits = {i: value for i, value in enumerate(commits.values())}  # Adjust idxs
+DATA_FILEPATH_MULTI_TASK = 'commits_multi_task.pkl'
+DATA_FILEPATH_WATERMARKS = 'commits_watermarks.pkl'
+
+# Stores are keyed by commit hash, older positional checkpoints are migrated on load
+commits = key_commits_by_hash(load_commits(DATA_FILEPATH_RAW_DATA) or {})  # To resume experiments
+zero_shot_outputs = load_experiment_outputs(DATA_FILEPATH_ZERO_SHOT)  # To resume experiments
+few_shots_outputs = load_experiment_outputs(DATA_FILEPATH_FEW_SHOTS)  # To resume experiments
+watermarks = load_commits(DATA_FILEPATH_WATERMARKS) or {}  # Newest processed hash per branch
+
+# Extract, filter and normalize only the commits added since the last run
+new_commits = extract_new_commits(LOCAL_PATH, watermarks, BRANCH, EXTRACTION_WORKERS, DEFAULT_CAPTURE_POLICY)
+if new_commits:
+    commits = merge_commits(new_commits, commits)
+    if EXTERNALIZE_DIFFS:  # Diff texts go to a deduplicated, memory-mapped blob file; the pickle keeps references only
+        externalize_diffs(commits, open_diff_store(os.path.join(CURRENT_DIRECTORY, "commits_diffs.blobs")))
     save_commits(commits, full_path(CURRENT_DIRECTORY, "raw"))
-    
-# Run Few-Shot and Zero-Shot experiments
-
-if commits_few_shots is None:
-  commits_few_shots = copy.deepcopy(commits)
-
-for i, (idx, commit) in tqdm(enumerate(commits_few_shots.items())):
-    # Run summarization and categorization only on unprocessed commits
-    if not commit['llama_summary'] and i < 100:
-      prompt = generate_prompt_summarization_few_shots(commit)
-      commit['llama_summary'] = ask_model_summarization(prompt, PIPE_LLAMA)
-    if not commit['llama_category']:
-      prompt = generate_prompt_categorization_few_shots(commit)
-      commit['llama_category'] = ask_model_categorization(prompt, PIPE_LLAMA)
-    save_commits(commits_few_shots, full_path(CURRENT_DIRECTORY,"few_shots"))
-
-plot_categories(commits_few_shots, "few_shots")
-plot_categories_piechart(commits_few_shots,"few_shots")
-
+save_commits(watermarks, full_path(CURRENT_DIRECTORY, "watermarks"))
 
-
-if commits_zero_shot is None:
-  commits_zero_shot = copy.deepcopy(commits)
-
-for i, (idx, commit) in tqdm(enumerate(commits_zero_shot.items())):
-    # Run categorization only on unprocessed commits
-    if commit['llama_category']:
-      prompt = generate_prompt_categorization_zero_shot(commit)
-      commit['llama_category'] = ask_model_categorization(prompt, PIPE_LLAMA)
-    save_commits(commits_zero_shot, full_path(CURRENT_DIRECTORY,"zero_shot"))
-
-plot_categories(commits_zero_shot, "zero_shot")
-plot_categories_piechart(commits_zero_shot, "zero_shot")
-
-# Generate technical summaries for few-shot commits
-
-for idx, (i, commit) in tqdm(enumerate(commits_few_shots.items())):
+# Run Few-Shot and Zero-Shot experiments
+# Both experiments read the same commit records and only store their own outputs
+
+# Snapshot the outputs only when new commits were added, the loops below journal each update
+stored_few_shots = len(few_shots_outputs)
+commits_few_shots = make_experiment(commits, few_shots_outputs)
+if len(few_shots_outputs) != stored_few_shots:
+    save_commits(few_shots_outputs, full_path(CURRENT_DIRECTORY, "few_shots"))
+
+# Run summarization and categorization only on unprocessed commits, in length-sorted batches
+# With the inference server both chains run at once and share its batches
+pending_summaries = [commit for i, commit in enumerate(commits_few_shots.values()) if not commit['llama_summary'] and i < 100]
+if CATEGORIZATION_MODE == 'score':
+    CATEGORY_FIELDS, ASK_MODEL_CATEGORIZATION_BATCH = ('llama_category', 'llama_category_confidence'), ask_model_categorization_scored_batch
+else:
+    CATEGORY_FIELDS, ASK_MODEL_CATEGORIZATION_BATCH = 'llama_category', ask_model_categorization_batch
+pending_categories = [commit for commit in commits_few_shots.values() if not commit['llama_category']]
+if USE_MULTI_TASK:
+    # Its prompt layout differs from the few-shot one, so its outputs are an experiment of their own
+    multi_task_outputs = load_experiment_outputs(DATA_FILEPATH_MULTI_TASK)
+    stored_multi_task = len(multi_task_outputs)
+    commits_multi_task = make_experiment(commits, multi_task_outputs)
+    if len(multi_task_outputs) != stored_multi_task:
+        save_commits(multi_task_outputs, full_path(CURRENT_DIRECTORY, "multi_task"))
+
+    # One prefill of each commit's context for all the outputs it is missing
+    pending_outputs = [(commit, [field for field in MULTI_TASK_HEADS if not commit[field] and (field == 'llama_category' or i < 100)])
+                       for i, commit in enumerate(commits_multi_task.values())]
+    pending_outputs = [(commit, fields) for commit, fields in pending_outputs if fields]
+    if pending_outputs:  # Building the MultiTaskPipe loads the model
+        annotate_multi_task(pending_outputs, MultiTaskPipe(PIPE_LLAMA), full_path(CURRENT_DIRECTORY, "multi_task"))
+
+    TABLE_MULTI_TASK_PATH = os.path.join(CURRENT_DIRECTORY, "commits_multi_task_table.npz")
+    if new_commits or pending_outputs or REPLOT or not os.path.exists(TABLE_MULTI_TASK_PATH):
+        table_multi_task = build_commit_table(commits_multi_task)
+        save_commit_table(table_multi_task, TABLE_MULTI_TASK_PATH)
+        plot_categories(table_multi_task, "multi_task")
+        plot_categories_piechart(table_multi_task, "multi_task")
+    pending_summaries = pending_categories = []  # The few-shot chains did not run
+else:
+    with ThreadPoolExecutor(2 if USE_INFERENCE_SERVER else 1) as chains:
+        chain_runs = [
+            chains.submit(annotate_in_batches, pending_summaries, 'llama_summary', generate_prompt_summarization_few_shots,
+                          partial(ask_model_summarization_batch, prompt_lookup_num_tokens=PROMPT_LOOKUP_NUM_TOKENS),
+                          PIPE_LLAMA, full_path(CURRENT_DIRECTORY, "few_shots"), INFERENCE_BATCH_SIZE, CHECKPOINT_EVERY),
+            chains.submit(annotate_in_batches, pending_categories, CATEGORY_FIELDS, generate_prompt_categorization_few_shots,
+                          ASK_MODEL_CATEGORIZATION_BATCH, PIPE_LLAMA, full_path(CURRENT_DIRECTORY, "few_shots"),
+                          INFERENCE_BATCH_SIZE, CHECKPOINT_EVERY),
+        ]
+        for chain_run in chain_runs:
+            chain_run.result()
+
+# Columnar copy of metadata and categories, later analyses can load it without any diff
+# Tables and plots are only rebuilt when an output changed (or with REPLOT)
+TABLE_FEW_SHOTS_PATH = os.path.join(CURRENT_DIRECTORY, "commits_few_shots_table.npz")
+if new_commits or pending_summaries or pending_categories or REPLOT or not os.path.exists(TABLE_FEW_SHOTS_PATH):
+    table_few_shots = build_commit_table(commits_few_shots)
+    save_commit_table(table_few_shots, TABLE_FEW_SHOTS_PATH)
+    plot_categories(table_few_shots, "few_shots")
+    plot_categories_piechart(table_few_shots,"few_shots")
+
+
+
+stored_zero_shot = len(zero_shot_outputs)
+commits_zero_shot = make_experiment(commits, zero_shot_outputs)
+if len(zero_shot_outputs) != stored_zero_shot:
+    save_commits(zero_shot_outputs, full_path(CURRENT_DIRECTORY, "zero_shot"))
+
+# Run categorization only on unprocessed commits
+pending_categories = [commit for commit in commits_zero_shot.values() if commit['llama_category']]
+annotate_in_batches(pending_categories, CATEGORY_FIELDS, generate_prompt_categorization_zero_shot, ASK_MODEL_CATEGORIZATION_BATCH,
+                    PIPE_LLAMA, full_path(CURRENT_DIRECTORY, "zero_shot"), INFERENCE_BATCH_SIZE, CHECKPOINT_EVERY)
+
+TABLE_ZERO_SHOT_PATH = os.path.join(CURRENT_DIRECTORY, "commits_zero_shot_table.npz")
+if new_commits or pending_categories or REPLOT or not os.path.exists(TABLE_ZERO_SHOT_PATH):
+    table_zero_shot = build_commit_table(commits_zero_shot)
+    save_commit_table(table_zero_shot, TABLE_ZERO_SHOT_PATH)
+    plot_categories(table_zero_shot, "zero_shot")
+    plot_categories_piechart(table_zero_shot, "zero_shot")
+
+# Generate technical summaries for few-shot commits (the multi-task experiment has its own)
+
+for idx, (i, commit) in tqdm(enumerate(commits_few_shots.items() if not USE_MULTI_TASK else ())):
   if 'llama_tech_summary' not in commit:
-    commit['llama_tech_summary'] = generate_technical_report(commit)
+    commit['llama_tech_summary'] = generate_technical_report(commit, PIPE_LLAMA, PROMPT_LOOKUP_NUM_TOKENS, generate_prompt_technical_analysis)
     #print(f"Processed commmit {idx+1}/{len(commits_few_shots)}")
-  save_commits(commits_few_shots, full_path(CURRENT_DIRECTORY,"few_shots"))
+    save_commit_fields(commit, ['llama_tech_summary'], full_path(CURRENT_DIRECTORY,"few_shots"))
+
+print_generation_stats()
+if USE_STAGED_PIPELINE:
+    print_stage_stats()
+print_budget_stats()
+if USE_RESPONSE_CACHE:
+    RESPONSE_CACHE.print_stats()
+if USE_INFERENCE_SERVER:
+    INFERENCE_SERVER.print_stats()
@@ -0,0 +1,117 @@
+from tqdm import tqdm
+from utils import clean_text_paragraph, save_commit_fields
+from categorization import CATEGORIES, CATEGORIZATION_GENERATION, parse_categorization_answer
+from summary import SUMMARIZATION_GENERATION
+from tech_summary import TECHNICAL_ANALYSIS_GENERATION
+from stopping import TASK_STOPS, StopWhenAnswerComplete, trim_answer, record_generation
+
+# Static part of every multi-task prompt: the instructions of all the tasks, prefilled once
+MULTI_TASK_PREAMBLE = clean_text_paragraph(f"""
+    You are an expert developer and code reviewer. You are given the details of a git commit, then one or more tasks about it.
+    - Categorization: classify the commit by its purpose and significance into exactly one of these categories:
+    {', '.join(CATEGORIES)}.
+    - Summary: provide a concise description of what has been done in the commit.
+    - Technical analysis: explain the changes in detail, covering Summary of Changes, Functionality, Performance, Correctness and Other Considerations.
+    Answer only the task asked, do not repeat the commit.
+    """) + "\n"
+
+# Output field -> task (see stopping.TASK_STOPS), question following the commit context,
+# generation settings of the chain, and how the chain parses the answer
+MULTI_TASK_HEADS = {
+    'llama_category': ('categorization', "Task: Categorization.\nCategory:", CATEGORIZATION_GENERATION,
+                       parse_categorization_answer),
+    'llama_summary': ('summarization', "Task: Summary.\nAnswer:", SUMMARIZATION_GENERATION,
+                      lambda answer: answer.split("Answer:")[-1]),
+    'llama_tech_summary': ('technical_analysis', "Task: Technical analysis.\nSummary of Changes:", TECHNICAL_ANALYSIS_GENERATION,
+                           lambda answer: answer.split("Summary of Changes:")[-1]),
+}
+
+
+def generate_multi_task_context(commit):
+    """
+    The part of a multi-task prompt shared by all the tasks of one commit.
+    """
+    context = f"""
+    Commit Informations:
+    - Hash (unique identifier): {commit['hash']}
+    - Author: {commit['author']}
+    - Date: {commit['date'].strftime('%Y-%m-%d %H:%M:%S')}
+    Commit Message - this provides a brief summary of the changes:
+    {commit['message']}
+    Changed Files - files modified in this commit:
+    {', '.join(commit['files'])}
+    Diffs - lines of code changed in each file:
+    {chr(10).join([f"{file_name}: {diff[:1000]}" for file_name, diff in commit['diffs'].items()])}
+    """
+    return clean_text_paragraph(context) + "\n"
+
+
+class MultiTaskPipe:
+    """
+    Answers several tasks about a commit from a single prefill of its context. Prompts
+    are laid out as MULTI_TASK_PREAMBLE (prefilled once for all commits), the commit
+    context (prefilled once per commit) and a short question per task (MULTI_TASK_HEADS).
+    Each task decodes from the cached state and the cache is cropped back to the context
+    afterwards, then to the preamble once the commit is done. Commits run one at a time.
+    """
+
+    def __init__(self, pipe, preamble=MULTI_TASK_PREAMBLE):
+        import torch
+        self.torch = torch
+        self.model = pipe.model
+        self.tokenizer = pipe.tokenizer
+        self.preamble_ids = self.tokenizer(preamble, return_tensors='pt').input_ids.to(self.model.device)
+        with torch.no_grad():
+            self.cache = self.model(self.preamble_ids, use_cache=True).past_key_values
+        self.prefilled_tokens = 0  # Context and question tokens prefilled for the commits
+
+    def _encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False, return_tensors='pt').input_ids.to(self.model.device)
+
+    def _generate(self, input_ids, task, generation):
+        """
+        Decodes the answer of a task after input_ids, whose prefix is in the cache.
+        """
+        from transformers import StoppingCriteriaList
+        criteria = StopWhenAnswerComplete(self.tokenizer, task=task, prompt_length=input_ids.shape[1], **TASK_STOPS[task])
+        with self.torch.no_grad():
+            output = self.model.generate(input_ids, attention_mask=self.torch.ones_like(input_ids), past_key_values=self.cache,
+                                         stopping_criteria=StoppingCriteriaList([criteria]),
+                                         pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id, **generation)
+        record_generation(task, criteria, generation.get('max_new_tokens', 20))
+        return trim_answer(self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True), task)
+
+    def annotate(self, commit, fields=tuple(MULTI_TASK_HEADS)):
+        """
+        Returns the answers of the tasks of MULTI_TASK_HEADS filling fields, by field.
+        """
+        n_preamble = self.preamble_ids.shape[1]
+        context_ids = self.torch.cat([self.preamble_ids, self._encode(generate_multi_task_context(commit))], dim=1)
+        answers = {}
+        try:
+            with self.torch.no_grad():
+                self.model(context_ids[:, n_preamble:], past_key_values=self.cache, use_cache=True)
+            self.prefilled_tokens += context_ids.shape[1] - n_preamble
+            for field in fields:
+                task, question, generation, parse = MULTI_TASK_HEADS[field]
+                input_ids = self.torch.cat([context_ids, self._encode(question)], dim=1)
+                self.prefilled_tokens += input_ids.shape[1] - context_ids.shape[1]
+                try:
+                    answers[field] = parse(self._generate(input_ids, task, generation))
+                finally:
+                    self.cache.crop(context_ids.shape[1])
+        finally:
+            self.cache.crop(n_preamble)
+        return answers
+
+
+def annotate_multi_task(pending, multi_task_pipe, store_path):
+    """
+    Fills the given fields of each (commit, fields) pair of pending with one
+    MultiTaskPipe pass per commit, journaling each commit once it is done.
+    """
+    for commit, fields in tqdm(pending, desc='multi-task'):
+        for field, answer in multi_task_pipe.annotate(commit, fields).items():
+            commit[field] = answer
+        save_commit_fields(commit, list(fields), store_path)
+    return pending
@@ -0,0 +1,93 @@
+import os
+from datetime import datetime, timezone
+from commit_record import Commit
+
+
+def placeholder_commit(seed):
+    """
+    Returns a made-up commit whose every field depends on seed.
+    """
+    return Commit(hash=str(seed) * 40, author=f"Author {seed}", date=datetime(2000 + seed, 1, 1, tzinfo=timezone.utc),
+                  message=f"Message {seed}", files=[f"file_{seed}.c"], diffs={f"file_{seed}.c": f"+ line {seed}"},
+                  llama_summary='', llama_category='', llama_tech_summary='')
+
+
+def static_prefix(generate_prompt):
+    """
+    Returns the part of a prompt template that does not depend on the commit: the common
+    prefix of the prompts of two unrelated commits, cut at its last line break.
+    """
+    first = generate_prompt(placeholder_commit(1))
+    second = generate_prompt(placeholder_commit(2))
+    common = len(os.path.commonprefix([first, second]))
+    return first[:first.rfind('\n', 0, common) + 1]
+
+
+class PrefixCachedPipe:
+    """
+    Drop-in replacement for the text-generation pipeline that keeps the past key/values
+    of the static prefix of each prompt template (see static_prefix). A prompt starting
+    with a known prefix only prefills its own tokens; the cache is cropped back to the
+    prefix after each generation, so it is never copied. Prompts without a known prefix,
+    or whose tokens do not split at the prefix boundary, are generated from scratch.
+    Prompts are run one at a time, lists are accepted for compatibility with the batched path.
+    """
+
+    batches_prompts = False  # generate_answers sends lists prompt by prompt, with their own stopping criteria
+
+    def __init__(self, pipe, prefixes=()):
+        import torch
+        self.torch = torch
+        self.pipe = pipe
+        self.model = pipe.model
+        self.tokenizer = pipe.tokenizer
+        self.prefixes = []
+        self.hits = 0
+        self.misses = 0
+        for prefix in prefixes:
+            self.add_prefix(prefix)
+
+    def add_prefix(self, prefix):
+        """
+        Runs a prefix through the model once and keeps its key/values.
+        """
+        input_ids = self.tokenizer(prefix, return_tensors='pt').input_ids.to(self.model.device)
+        with self.torch.no_grad():
+            cache = self.model(input_ids, use_cache=True).past_key_values
+        self.prefixes.append((prefix, input_ids, cache))
+        self.prefixes.sort(key=lambda entry: len(entry[0]), reverse=True)  # Longest match first
+
+    def _find_prefix(self, prompt, input_ids):
+        for prefix, prefix_ids, cache in self.prefixes:
+            n = prefix_ids.shape[1]
+            if prompt.startswith(prefix) and input_ids.shape[1] > n and self.torch.equal(input_ids[:, :n], prefix_ids):
+                return n, cache
+        return None, None
+
+    def generate(self, prompt, return_full_text=True, **generate_kwargs):
+        """
+        Returns the generated text, after the prompt unless return_full_text is False,
+        like the pipeline's 'generated_text'.
+        """
+        input_ids = self.tokenizer(prompt, return_tensors='pt').input_ids.to(self.model.device)
+        generate_kwargs.setdefault('pad_token_id', self.tokenizer.pad_token_id or self.tokenizer.eos_token_id)
+        n_cached, cache = self._find_prefix(prompt, input_ids)
+        if cache is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            generate_kwargs['past_key_values'] = cache
+
+        try:
+            with self.torch.no_grad():
+                output = self.model.generate(input_ids, attention_mask=self.torch.ones_like(input_ids), **generate_kwargs)
+        finally:
+            if cache is not None:
+                cache.crop(n_cached)
+        answer = self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+        return prompt + answer if return_full_text else answer
+
+    def __call__(self, prompts, batch_size=None, **generate_kwargs):
+        if isinstance(prompts, str):
+            return [{'generated_text': self.generate(prompts, **generate_kwargs)}]
+        return [[{'generated_text': self.generate(prompt, **generate_kwargs)}] for prompt in prompts]
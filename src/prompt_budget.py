@@ -0,0 +1,135 @@
+from fnmatch import fnmatch
+
+# Total prompt tokens per task; the diffs get whatever the rest of the prompt leaves
+PROMPT_TOKEN_BUDGETS = {
+    'categorization': 3072,
+    'summarization': 3072,
+    'technical_analysis': 3072,
+}
+
+# Files whose diffs are only kept if the source files leave room for them
+GENERATED_GLOBS = ['*.lock', '*-lock.json', '*.min.js', '*.min.css', '*.map', '*.pb.go', '*_pb2.py',
+                   '*.generated.*', '*/generated/*', 'dist/*', 'build/*', '*.svg']
+
+MIN_FILE_TOKENS = 24  # A diff cut shorter than this is dropped instead
+MAX_DIFF_CHARS = 1000  # Per-file cap the prompt builders already apply
+MAX_LISTED_FILES = 50  # Changed files named in the prompt, the others are only counted
+
+# Per task: prompts built, diffs kept, truncated and dropped, tokens dropped, largest prompt
+BUDGET_STATS = {}
+
+
+def is_generated(file_name):
+    return any(fnmatch(file_name, pattern) for pattern in GENERATED_GLOBS)
+
+
+def encode(tokenizer, text):
+    """
+    Tokenizes text without special tokens, or splits it in 4-character pieces when
+    there is no tokenizer (e.g. a stub pipe), which is about the same count for code.
+    """
+    if tokenizer is None:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    return tokenizer.encode(text, add_special_tokens=False)
+
+
+def decode(tokenizer, tokens):
+    return ''.join(tokens) if tokenizer is None else tokenizer.decode(tokens)
+
+
+def allocate_tokens(costs, budget, min_tokens=MIN_FILE_TOKENS):
+    """
+    Spreads budget over costs, a list of (name, tokens wanted) in priority order.
+    Each entry gets what it wants up to an equal share of what is left, so cheap entries
+    are kept whole and the expensive ones split the remainder. While that leaves some
+    entry with less than min_tokens, the last entry in priority order is dropped (0).
+    """
+    costs = list(costs)
+    allocation = {}
+    while True:
+        remaining = budget
+        for k, (name, cost) in enumerate(costs):
+            allocation[name] = min(cost, remaining // (len(costs) - k))
+            remaining -= allocation[name]
+        if not costs or all(allocation[name] >= min(cost, min_tokens) for name, cost in costs):
+            return allocation
+        name, _ = costs.pop()
+        allocation[name] = 0
+
+
+def budget_commit(commit, generate_prompt, tokenizer, max_tokens):
+    """
+    Returns a copy of commit whose diffs fit the prompt of generate_prompt in max_tokens
+    tokens, and a report of what was cut. Diffs are served smallest first, source files
+    before generated ones; the cut ones are truncated at a token boundary or dropped,
+    the others are kept as they are.
+    Only the first MAX_LISTED_FILES changed files are listed.
+    """
+    files = commit['files']
+    if len(files) > MAX_LISTED_FILES:
+        files = files[:MAX_LISTED_FILES] + [f"... ({len(files) - MAX_LISTED_FILES} more files)"]
+    fixed_tokens = len(encode(tokenizer, generate_prompt({**commit, 'files': files, 'diffs': {}})))
+    costs = []
+    tokens = {}
+    for file_name, diff in commit['diffs'].items():
+        name_tokens = len(encode(tokenizer, f"{file_name}: ")) + 1  # + the line break
+        tokens[file_name] = encode(tokenizer, diff[:MAX_DIFF_CHARS])
+        costs.append((file_name, name_tokens + len(tokens[file_name]), name_tokens))
+    costs.sort(key=lambda cost: (is_generated(cost[0]), cost[1]))
+
+    allocation = allocate_tokens([(file_name, cost) for file_name, cost, _ in costs], max(max_tokens - fixed_tokens, 0))
+    name_tokens = {file_name: n for file_name, _, n in costs}
+    diffs = {}
+    report = {'kept': 0, 'truncated': [], 'dropped': [], 'tokens_dropped': 0}
+    for file_name in commit['diffs']:
+        diff_tokens = tokens[file_name]
+        keep = max(allocation[file_name] - name_tokens[file_name], 0)
+        if allocation[file_name] == 0:
+            report['dropped'].append(file_name)
+        elif keep < len(diff_tokens):
+            report['truncated'].append(file_name)
+            diffs[file_name] = decode(tokenizer, diff_tokens[:keep])
+        else:
+            report['kept'] += 1
+            diffs[file_name] = commit['diffs'][file_name][:MAX_DIFF_CHARS]  # Untouched, decoding may not round-trip
+        report['tokens_dropped'] += len(diff_tokens) - min(keep, len(diff_tokens))
+
+    return {**commit, 'files': files, 'diffs': diffs}, report
+
+
+def record_budget(task, report, prompt_tokens):
+    stats = BUDGET_STATS.setdefault(task, {'prompts': 0, 'kept': 0, 'truncated': 0, 'dropped': 0,
+                                           'tokens_dropped': 0, 'max_prompt_tokens': 0})
+    stats['prompts'] += 1
+    stats['kept'] += report['kept']
+    stats['truncated'] += len(report['truncated'])
+    stats['dropped'] += len(report['dropped'])
+    stats['tokens_dropped'] += report['tokens_dropped']
+    stats['max_prompt_tokens'] = max(stats['max_prompt_tokens'], prompt_tokens)
+    return stats
+
+
+def budgeted(generate_prompt, task, pipe, max_tokens=None):
+    """
+    Wraps a prompt builder so the prompts it returns fit the task's token budget, counted
+    with the tokenizer of pipe. The tokenizer is looked up on the first prompt, so a
+    LazyPipeline is not loaded before a prompt is needed. What was cut is added to BUDGET_STATS.
+    """
+    max_tokens = max_tokens or PROMPT_TOKEN_BUDGETS[task]
+
+    def generate_budgeted_prompt(commit, *args, **kwargs):
+        tokenizer = getattr(pipe, 'tokenizer', None)
+        commit, report = budget_commit(commit, lambda view: generate_prompt(view, *args, **kwargs), tokenizer, max_tokens)
+        prompt = generate_prompt(commit, *args, **kwargs)
+        record_budget(task, report, len(encode(tokenizer, prompt)))
+        return prompt
+
+    generate_budgeted_prompt.__name__ = generate_prompt.__name__
+    return generate_budgeted_prompt
+
+
+def print_budget_stats():
+    for task, stats in BUDGET_STATS.items():
+        print(f"{task}: {stats['prompts']} prompts, diffs kept {stats['kept']}, truncated {stats['truncated']}, "
+              f"dropped {stats['dropped']}, {stats['tokens_dropped']} diff tokens dropped, "
+              f"largest prompt {stats['max_prompt_tokens']} tokens")
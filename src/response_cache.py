@@ -0,0 +1,148 @@
+import os, json, time, sqlite3, hashlib, threading
+
+
+class ResponseCache:
+    """
+    On-disk cache of model answers in SQLite, keyed by a hash of the model id, the
+    prompt and the generation settings. When the stored answers exceed max_bytes the
+    least recently used ones are evicted until the cache is back under 90% of it.
+    """
+
+    def __init__(self, path, max_bytes=256 * 2**20):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.stats = {}  # task -> {'hits', 'misses', 'uncacheable'}
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_id, prompt, settings):
+        payload = json.dumps([model_id, prompt, settings], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def count(self, task, outcome):
+        with self.lock:  # Chains running in threads count at the same time
+            stats = self.stats.setdefault(task, {'hits': 0, 'misses': 0, 'uncacheable': 0})
+            stats[outcome] += 1
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+        return None if row is None else row[0]
+
+    def put(self, key, response):
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict(int(0.9 * self.max_bytes))
+            self.connection.commit()
+
+    def _evict(self, target_bytes):
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.size <= target_bytes:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def print_stats(self):
+        with self.lock:
+            snapshot = {task: dict(stats) for task, stats in self.stats.items()}
+        for task, stats in snapshot.items():
+            lookups = stats['hits'] + stats['misses']
+            print(f"{task}: {stats['hits']}/{lookups} cache hits ({stats['hits'] / max(lookups, 1):.0%}), "
+                  f"{stats['uncacheable']} sampled calls not cached")
+        print(f"Response cache: {self.size / 2**20:.1f} MB, {self.evictions} evicted")
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedPipe:
+    """
+    Wraps a text-generation pipeline (or PrefixCachedPipe) so deterministic calls
+    (do_sample=False) are answered from a ResponseCache when the same model already
+    answered the same prompt with the same settings. Only the prompts of a batch that
+    miss are sent to the model, still as one batch. Other attributes (tokenizer,
+    model) are the wrapped pipeline's.
+    """
+
+    def __init__(self, pipe, cache, model_id=None):
+        self.pipe = pipe
+        self.cache = cache
+        if model_id is None:  # Looking the model up would load a LazyPipeline, pass model_id to avoid it
+            model_id = getattr(getattr(pipe, 'model', None), 'name_or_path', None) or type(pipe).__name__
+        self.model_id = model_id  # Or a function returning it, called on the first prompt
+
+    def _model_id(self):
+        if callable(self.model_id):
+            self.model_id = self.model_id()
+        return self.model_id
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def _settings(self, generate_kwargs):
+        """
+        The generation settings that change the answer. Stopping criteria are objects,
+        they are described by the task rules they apply. Prompt lookup does not change
+        greedy answers either.
+        """
+        ignored = ('stopping_criteria', 'batch_size', 'prompt_lookup_num_tokens')
+        settings = {name: value for name, value in generate_kwargs.items() if name not in ignored}
+        task = None
+        for criteria in generate_kwargs.get('stopping_criteria') or ():
+            task = getattr(criteria, 'task', None) or task
+            settings.setdefault('stopping_criteria', []).append(
+                [type(criteria).__name__, getattr(criteria, 'stop_strings', None), getattr(criteria, 'required_lines', None)])
+        return settings, task or 'generation'
+
+    def __call__(self, prompts, **generate_kwargs):
+        settings, task = self._settings(generate_kwargs)
+        single = isinstance(prompts, str)
+        prompts = [prompts] if single else prompts
+        if generate_kwargs.get('do_sample', False):
+            for _ in prompts:
+                self.cache.count(task, 'uncacheable')
+            outputs = self.pipe(prompts[0] if single else prompts, **generate_kwargs)
+            return outputs
+
+        keys = [ResponseCache.make_key(self._model_id(), prompt, settings) for prompt in prompts]
+        answers = [self.cache.get(key) for key in keys]
+        missing = [i for i, answer in enumerate(answers) if answer is None]
+        for i in range(len(prompts)):
+            self.cache.count(task, 'misses' if answers[i] is None else 'hits')
+
+        if missing:
+            if single:
+                outputs = [self.pipe(prompts[0], **generate_kwargs)]
+            else:
+                if 'batch_size' in generate_kwargs:
+                    generate_kwargs['batch_size'] = len(missing)
+                outputs = self.pipe([prompts[i] for i in missing], **generate_kwargs)
+            for i, output in zip(missing, outputs):
+                answers[i] = output[0]['generated_text']
+                self.cache.put(keys[i], answers[i])
+
+        if single:
+            return [{'generated_text': answers[0]}]
+        return [[{'generated_text': answer}] for answer in answers]
@@ -0,0 +1,110 @@
+import os, sys
+import multiprocessing
+from utils import save_commit_fields, replay_journal, journal_path
+from inference import annotate_in_batches
+
+
+def shard_of(hexsha, n_shards):
+    """
+    Shard of a commit, from its hash so it does not change between runs.
+    """
+    return int(hexsha[:8], 16) % n_shards
+
+
+def shard_path(store_path, index, field):
+    """
+    Store whose journal holds the outputs of one shard of store_path for field (the
+    first one when a tuple), so chains writing to the same store keep apart shards.
+    """
+    name = field[0] if isinstance(field, tuple) else field
+    return f"{os.path.splitext(store_path)[0]}_{name}_shard{index}.pkl"
+
+
+def cpu_group(index, n_groups):
+    """
+    The CPUs of the index-th of n_groups equal slices of the CPUs this process may use.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    size = max(len(cpus) // n_groups, 1)
+    return cpus[index * size % len(cpus):][:size]
+
+
+def merge_shards(commits, field, store_path, n_shards):
+    """
+    Applies the shard journals of store_path to commits, writes the updates to the
+    journal of store_path in the order of commits (the lines of a serial run) and
+    removes the shard journals. Returns the hashes of the updated commits.
+    """
+    fields = list(field) if isinstance(field, tuple) else [field]
+    commits_by_hash = {commit['hash']: commit for commit in commits}
+    merged = set()
+    for index in range(n_shards):
+        path = shard_path(store_path, index, field)
+        if os.path.exists(journal_path(path)):
+            shard = {hexsha: {'hash': hexsha} for hexsha in commits_by_hash}
+            replay_journal(shard, path)
+            for hexsha, outputs in shard.items():
+                if len(outputs) > 1:
+                    commits_by_hash[hexsha].update((name, outputs[name]) for name in fields if name in outputs)
+                    merged.add(hexsha)
+    for commit in commits:
+        if commit['hash'] in merged:
+            save_commit_fields(commit, fields, store_path)
+    for index in range(n_shards):
+        if os.path.exists(journal_path(shard_path(store_path, index, field))):
+            os.remove(journal_path(shard_path(store_path, index, field)))
+    return merged
+
+
+def _run_shard(index, devices, setup_worker, annotate, commits, field, generate_prompt, ask_model_batch, pipe,
+               store_path, batch_size, checkpoint_every):
+    device = devices[index]
+    if device == -1:  # CPU workers get their own group of cores
+        cpus = cpu_group(sum(1 for other in devices[:index] if other == -1), devices.count(-1))
+        os.sched_setaffinity(0, cpus)
+        os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+        if 'torch' in sys.modules:
+            sys.modules['torch'].set_num_threads(len(cpus))
+    if setup_worker is not None:
+        setup_worker(device)
+    annotate(commits, field, generate_prompt, ask_model_batch, pipe, shard_path(store_path, index, field), batch_size, checkpoint_every)
+
+
+def run_sharded(commits, field, generate_prompt, ask_model_batch, pipe, store_path, batch_size=8, checkpoint_every=64,
+                devices=(-1, -1), setup_worker=None, annotate=annotate_in_batches):
+    """
+    Same arguments and result as annotate_in_batches, with the commits split by hash
+    over one worker process per entry of devices (a GPU index, or -1 for a CPU worker
+    pinned to its own group of cores). setup_worker(device) is called first in each
+    worker, e.g. to pick the device its pipeline will load on; workers then annotate
+    their shard with annotate and journal it in their own store (see shard_path).
+    Once they are done the shards are merged into store_path (see merge_shards).
+    Shards left over by an interrupted run are merged first and their commits skipped.
+
+    Workers are forked: pipe must not be loaded yet (each worker loads its own, CUDA
+    cannot be used across a fork) and must not rely on threads or connections of
+    this process.
+    """
+    n_shards = len(devices)
+    done = merge_shards(commits, field, store_path, n_shards)
+    shards = [[] for _ in range(n_shards)]
+    for commit in commits:
+        if commit['hash'] not in done:
+            shards[shard_of(commit['hash'], n_shards)].append(commit)
+
+    context = multiprocessing.get_context('fork')
+    workers = {}
+    for index, shard in enumerate(shards):
+        if shard:
+            workers[index] = context.Process(target=_run_shard, name=f'shard-{index}', args=(
+                index, list(devices), setup_worker, annotate, shard, field, generate_prompt, ask_model_batch, pipe,
+                store_path, batch_size, checkpoint_every))
+            workers[index].start()
+    for worker in workers.values():
+        worker.join()
+
+    merge_shards(commits, field, store_path, n_shards)
+    failed = [index for index, worker in workers.items() if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, the commits they finished were merged")
+    return commits
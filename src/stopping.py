@@ -0,0 +1,115 @@
+# Where the answer of each task ends:
+# - stop_strings: text that only appears once the model moved past its answer (e.g. starts
+#   another example); generation stops there and the answer is cut before it.
+# - required_lines: generation stops once a line containing each marker has been completed
+#   ('' is any non-blank line, i.e. the first line of the answer).
+TASK_STOPS = {
+    'categorization': dict(stop_strings=('**Example', 'Commit Informations'), required_lines=('',)),
+    'summarization': dict(stop_strings=('\nExample', 'Commit Informations', 'Now analyze', '\nAnswer:'), required_lines=()),
+    'technical_analysis': dict(stop_strings=('\nExample', 'Commit Informations', 'Now analyze'), required_lines=('Other Considerations',)),
+    'quality_assurance': dict(stop_strings=('\nExample', 'Technical Summary:'), required_lines=('Mark', 'Improvement Suggestions')),
+    'user_story': dict(stop_strings=('**Example', '**Input', '\n---'), required_lines=()),
+}
+
+# Per task: generate calls, tokens generated, calls ended by the task's rules and tokens they saved
+GENERATION_STATS = {}
+
+
+class StopWhenAnswerComplete:
+    """
+    Stopping criterion for model.generate (one instance per generate call) applying the
+    rules of a task from TASK_STOPS to each sequence of the batch. The tokens added
+    since the previous step are decoded and appended to the text of each sequence, so
+    the check costs the same at token 10 and at token 5000. A step usually adds one
+    token; with prompt lookup (assisted) decoding it can add several, the prompt length
+    must then be given since the first step already may.
+    """
+
+    def __init__(self, tokenizer, stop_strings=(), required_lines=(), task=None, prompt_length=None):
+        self.tokenizer = tokenizer
+        self.task = task
+        self.stop_strings = stop_strings
+        self.required_lines = required_lines
+        self.end_token_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id} - {None}
+        self.prompt_length = prompt_length
+        self.length = None  # Sequence length at the previous step
+        self.texts = []
+        self.completed = []
+        self.generated = []  # Tokens generated by each sequence when it ended, None while running
+        self.stopped = []  # Whether the sequence was ended by the task's rules
+
+    def _line_completed(self, row, line):
+        for marker in self.required_lines:
+            if marker in line and (line.split(marker, 1)[-1] if marker else line).strip(' :*-'):
+                self.completed[row].add(marker)
+
+    def _add_token(self, row, token, n_generated):
+        """
+        Appends one token to the text of a row, returns whether the row is finished.
+        """
+        if token in self.end_token_ids:
+            self.generated[row] = n_generated
+            return True
+
+        piece = self.tokenizer.decode([token])
+        text = self.texts[row] + piece
+        self.texts[row] = text
+        if '\n' in piece and self.required_lines:
+            for line in text[:text.rfind('\n')].split('\n')[-piece.count('\n'):]:
+                self._line_completed(row, line)
+        tail = text[-(len(piece) + max(map(len, self.stop_strings), default=0)):]
+        if any(stop in tail for stop in self.stop_strings) or (
+                self.required_lines and len(self.completed[row]) == len(self.required_lines)):
+            self.generated[row] = n_generated
+            self.stopped[row] = True
+            return True
+        return False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.length is None:
+            if self.prompt_length is None:
+                self.prompt_length = input_ids.shape[1] - 1
+            self.length = self.prompt_length
+            self.texts = [''] * input_ids.shape[0]
+            self.completed = [set() for _ in range(input_ids.shape[0])]
+            self.generated = [None] * input_ids.shape[0]
+            self.stopped = [False] * input_ids.shape[0]
+
+        done = input_ids.new_zeros(input_ids.shape[0]).bool()
+        for row in range(input_ids.shape[0]):
+            for position in range(self.length, input_ids.shape[1]):
+                if self.generated[row] is not None:
+                    break
+                self._add_token(row, input_ids[row, position].item(), position + 1 - self.prompt_length)
+            done[row] = self.generated[row] is not None
+        self.length = input_ids.shape[1]
+        return done
+
+
+def trim_answer(answer, task):
+    """
+    Cuts an answer before the first stop string of its task.
+    """
+    positions = [answer.find(stop) for stop in TASK_STOPS[task]['stop_strings'] if stop in answer]
+    return answer[:min(positions)] if positions else answer
+
+
+def record_generation(task, criteria, max_new_tokens):
+    """
+    Adds the outcome of one generate call to GENERATION_STATS.
+    """
+    stats = GENERATION_STATS.setdefault(task, {'sequences': 0, 'generated_tokens': 0, 'stopped_early': 0, 'saved_tokens': 0})
+    for generated, stopped in zip(criteria.generated, criteria.stopped):
+        generated = max_new_tokens if generated is None else generated
+        stats['sequences'] += 1
+        stats['generated_tokens'] += generated
+        if stopped:
+            stats['stopped_early'] += 1
+            stats['saved_tokens'] += max_new_tokens - generated
+    return stats
+
+
+def print_generation_stats():
+    for task, stats in GENERATION_STATS.items():
+        print(f"{task}: {stats['sequences']} sequences, {stats['generated_tokens']} tokens generated, "
+              f"{stats['stopped_early']} stopped by the task rules, {stats['saved_tokens']} tokens saved")
@@ -1,5 +1,6 @@
 import re
 from utils import clean_text_paragraph
+from inference import generate_answers
 
 
 def prompt_story_summary(role, pair):
@@ -140,13 +141,15 @@ def ask_model_final_user_story(prompt, pipe):
     """
     Ask the model to summarize a git commit.
     """
-    answer = pipe(
+    answer = generate_answers(
+        pipe,
         prompt,
+        'user_story',  # Stops when the model starts another example instead of running to the cap
         max_new_tokens=5000,
         do_sample=True,
         temperature=0.7,
         top_p=0.9,
-    )[0]['generated_text']
+    )
 
     answer = answer.split("**Output:**")[-1]
     return answer
@@ -1,5 +1,6 @@
 import re
 from utils import clean_text_paragraph
+from inference import generate_answers, generate_batched
 
 def generate_prompt_summarization(commit):
     """
@@ -143,18 +144,32 @@ def generate_prompt_summarization_few_shots(commit):
 
 
 
-def ask_model_summarization(prompt, pipe):
+SUMMARIZATION_GENERATION = dict(
+    max_new_tokens=200,
+    do_sample=False,
+    temperature=None,
+    top_p=None,
+)
+
+def ask_model_summarization(prompt, pipe, prompt_lookup_num_tokens=None):
     """
     Ask the model to summarize a git commit.
+    prompt_lookup_num_tokens turns on prompt lookup decoding (see inference.generate_answers),
+    summaries copy identifiers and paths from the diff.
     """
-    answer = pipe(
-        prompt,
-        max_new_tokens=200,
-        do_sample=False,
-        temperature=None,
-        top_p=None,
-    )[0]['generated_text']
+    answer = generate_answers(pipe, prompt, 'summarization', prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+                              **SUMMARIZATION_GENERATION)
 
     answer = answer.split("Answer:")[-1]
     return answer
 
+def ask_model_summarization_batch(prompts, pipe, batch_size=8, prompt_lookup_num_tokens=None):
+    """
+    Ask the model to summarize several git commits, in length-sorted batches
+    (one at a time with prompt_lookup_num_tokens).
+    Summaries are returned in the order of prompts.
+    """
+    answers = generate_batched(prompts, pipe, batch_size, 'summarization', prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+                               **SUMMARIZATION_GENERATION)
+    return [answer.split("Answer:")[-1] for answer in answers]
+
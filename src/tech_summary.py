@@ -1,4 +1,5 @@
 from utils import clean_text_paragraph
+from inference import generate_answers
 
 def generate_prompt_technical_analysis(commit, comment=None):
   """
@@ -148,26 +149,36 @@ def generate_quality_assurance_prompt(technical_summary):
     return prompt
 
 
-def ask_model_technical_analysis(prompt, pipe):
-  answer = pipe(
+TECHNICAL_ANALYSIS_GENERATION = dict(
+    max_new_tokens=500,
+    do_sample=True,
+    top_p=None,
+    temperature=0.7
+)
+
+def ask_model_technical_analysis(prompt, pipe, prompt_lookup_num_tokens=None):
+  # prompt_lookup_num_tokens: prompt lookup decoding, see inference.generate_answers
+  answer = generate_answers(
+      pipe,
       prompt,
-      max_new_tokens= 500,
-      do_sample=True,
-      top_p = None,
-      temperature= 0.7
-  )[0]['generated_text']
+      'technical_analysis',
+      prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+      **TECHNICAL_ANALYSIS_GENERATION
+  )
 
   answer = answer.split("Summary of Changes:")[-1]
   return answer
 
 def ask_model_quality_assurance(prompt, pipe):
-  answer = pipe(
+  answer = generate_answers(
+      pipe,
       prompt,
+      'quality_assurance',  # Stops once the Mark and Improvement Suggestions lines are written
       max_new_tokens=500,  # Increased tokens
       do_sample=True,
       top_p=None,
       temperature=0.7
-  )[0]['generated_text']
+  )
 
   answer = answer.split("Answer:")[-1]
   # Extract decision (True/False) and improvement suggestions (comment)
@@ -191,7 +202,11 @@ def ask_model_quality_assurance(prompt, pipe):
   return mark, improvement_suggestions
 
 
-def generate_technical_report(commit, pipe_llama):
+def generate_technical_report(commit, pipe_llama, prompt_lookup_num_tokens=None, generate_prompt=generate_prompt_technical_analysis):
+  """
+  Technical analysis of a commit, regenerated with the QA suggestions until QA rates it high enough.
+  generate_prompt builds the analysis prompt, e.g. a budgeted generate_prompt_technical_analysis.
+  """
   mark_qa = -1
   improvements = None
   technical_summary= None
@@ -199,8 +214,8 @@ def generate_technical_report(commit, pipe_llama):
 
   while int(mark_qa) < THRESHOLD:
 
-    prompt = generate_prompt_technical_analysis(commit, improvements)
-    technical_summary = ask_model_technical_analysis(prompt, pipe_llama)
+    prompt = generate_prompt(commit, improvements)
+    technical_summary = ask_model_technical_analysis(prompt, pipe_llama, prompt_lookup_num_tokens)
 
     qa_prompt = generate_quality_assurance_prompt(technical_summary)
     mark_qa, improvements = ask_model_quality_assurance(qa_prompt, pipe_llama)
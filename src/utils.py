@@ -1,7 +1,14 @@
-import re, os, pickle
-from git import Repo
-from matplotlib import pyplot as plt
-from collections import defaultdict
+import re, os, json, pickle, subprocess, threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from fnmatch import fnmatch
+from git_objects import CatFileBatch, diff_trees, diff_blobs
+from commit_record import Commit
+from blob_store import pickled_in
+from analytics import as_commit_table, count_categories_by_quarter, count_categories, precision_recall_from_table
+from collections import ChainMap
+from types import MappingProxyType
 
 def filter_diff_lines(diff_text):
     """
@@ -21,126 +28,574 @@ def filter_diff_lines(diff_text):
             filtered_lines.append(line)
     return '\n'.join(filtered_lines)
 
-def extract_git_commits(repo_path, branch='master'):
+def extract_git_commits(repo_path, branch='master', capture_policy=None, use_cat_file=False):
     """
     Extracts commit information from a Git repository.
+    If capture_policy is given, diffs are budgeted as described in apply_capture_policy.
+    With use_cat_file, file lists and diffs are built from objects read through one
+    persistent `git cat-file --batch` process (see diff_commit_objects) instead of
+    spawning git twice per commit. Those diffs are computed by difflib, not git: the
+    changed lines can be paired differently than in `git log -p` and edited renames
+    are not detected, so outputs compared with the ground truth, which was labeled
+    from git's diffs, should come from the default path.
     """
+    from git import Repo  # GitPython is only needed by this extraction path
+
     repo = Repo(repo_path)
     commits = list(repo.iter_commits(branch))
     commits_dict = {}
+    objects = CatFileBatch(repo_path) if use_cat_file else None
+
+    try:
+        for i, commit in enumerate(commits):
+            commits_dict[i] = Commit({
+                'hash': commit.hexsha,
+                'author': f"{commit.author.name} <{commit.author.email}>",
+                'date': commit.authored_datetime,
+                'message': commit.message.strip(),
+                'files': [],
+                'diffs': {},
+                'llama_summary': '',
+                'llama_category': '',
+                'llama_tech_summary': ''
+            })
+
+            if objects is not None:
+                parent_tree = commit.parents[0].tree.hexsha if commit.parents else None
+                files, diffs, binary_files = diff_commit_objects(objects, commit.tree.hexsha, parent_tree)
+                commits_dict[i]['files'] = files
+                commits_dict[i]['diffs'] = diffs
+            else:
+                commits_dict[i]['files'] = list(commit.stats.files.keys())
+                diffs = commit.diff(commit.parents[0] if commit.parents else None, create_patch=True)
+                binary_files = set()
+                file_diffs = {}
+
+                for diff in diffs:
+                    file_diff = diff.diff.decode('utf-8', errors='replace')
+                    file_name = f"{diff.a_path} -> {diff.b_path}" if diff.a_path != diff.b_path else diff.a_path
+                    if file_diff.startswith('Binary files '):
+                        binary_files.add(file_name)
+                    file_diffs[file_name] = filter_diff_lines(file_diff)
+                commits_dict[i]['diffs'] = file_diffs
+
+            if capture_policy is not None:
+                apply_capture_policy(commits_dict[i], binary_files, capture_policy)
+    finally:
+        if objects is not None:  # Also on errors, or the two cat-file processes outlive the extraction
+            objects.close()
+
+    if objects is not None:
+        print(f"Object cache: {objects.hits} hits, {objects.misses} misses")
+    print(f"Extracted {len(commits_dict)} commits")
+    return commits_dict
+
+
+def diff_commit_objects(objects, tree, parent_tree):
+    """
+    Builds the files list, filtered diffs and binary file names of a commit from its
+    tree and its first parent's tree, read through a CatFileBatch.
+    Keys follow GitPython's commit -> parent orientation. Only exact renames are
+    detected; a renamed and edited file shows up as a deletion plus an addition.
+    The diffs come from difflib (see diff_blobs) and can differ from git's.
+    """
+    changes = diff_trees(objects, tree, parent_tree)
+    files = sorted({path for path, _, _ in changes})
+    diffs = {}
+    binary_files = set()
+
+    # Pair blobs that only moved: present in the commit under one path, in the parent under another
+    only_in_parent = {b_sha: path for path, a_sha, b_sha in changes if a_sha is None}
+    renamed = set()
+    for path, a_sha, b_sha in changes:
+        if b_sha is None and a_sha in only_in_parent and only_in_parent[a_sha] not in renamed:
+            renamed.update((path, only_in_parent[a_sha]))
+            diffs[f"{path} -> {only_in_parent[a_sha]}"] = ''
+
+    for path, a_sha, b_sha in changes:
+        if path in renamed:
+            continue
+        diff = diff_blobs(objects, a_sha, b_sha)
+        if diff is None:
+            binary_files.add(path)
+            diffs[path] = ''
+        elif a_sha is None:
+            diffs[f"None -> {path}"] = filter_diff_lines(diff)
+        elif b_sha is None:
+            diffs[f"{path} -> None"] = filter_diff_lines(diff)
+        else:
+            diffs[path] = filter_diff_lines(diff)
+
+    return files, diffs, binary_files
+
+
+# One NUL-separated header per commit; the patch follows until the next header.
+GIT_LOG_FORMAT = '%x00%H%x00%an%x00%ae%x00%aI%x00%B%x00'
+GIT_LOG_HEADER_FIELDS = 6
+
+
+def iter_git_log(repo_path, branch='master', hashes=None):
+    """
+    Streams a single `git log -p` process and yields, for each commit, its
+    header fields and the raw lines of its patch.
+    branch can be any revision or range accepted by `git log` (e.g. "abc123..master").
+    If hashes is given, exactly those commits are logged, in that order, instead of branch.
+
+    The patch is taken against the first parent and reversed (-R), which is the
+    orientation produced by GitPython's `commit.diff(commit.parents[0])`.
+    """
+    revisions = [branch] if hashes is None else ['--no-walk=unsorted', '--stdin']
+    command = [
+        'git', '-C', repo_path, '-c', 'core.quotepath=off',
+        'log', *revisions, '--no-color', '--no-ext-diff', '--no-textconv', '--no-use-mailmap',
+        '-p', '-R', '-M', '--root', '--no-prefix', '--diff-merges=first-parent',
+        f'--format={GIT_LOG_FORMAT}',
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # git reads all revisions from stdin before it starts writing the log
+    process.stdin.write(''.join(f"{hexsha}\n" for hexsha in hashes or []).encode('ascii'))
+    process.stdin.close()
+    try:
+        fields = None
+        header = b''
+        patch_lines = []
+        for raw_line in process.stdout:
+            # Header lines start with NUL; a multi-line message keeps the header open
+            if header or raw_line.startswith(b'\x00'):
+                header += raw_line
+                if header.count(b'\x00') == GIT_LOG_HEADER_FIELDS:
+                    if fields is not None:
+                        yield fields, patch_lines
+                    fields = header.decode('utf-8', errors='replace').split('\x00')[1:GIT_LOG_HEADER_FIELDS]
+                    header = b''
+                    patch_lines = []
+                continue
+            patch_lines.append(raw_line.decode('utf-8', errors='replace').rstrip('\n'))
+        if fields is not None:
+            yield fields, patch_lines
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    finally:
+        # Stop git if the consumer did not read the whole history
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def parse_git_patch(patch_lines):
+    """
+    Splits the patch of one commit into per-file diffs.
+
+    Returns the list of touched paths (renames count as both paths, like
+    `commit.stats`), a dict mapping the GitPython-style file name
+    ("a -> b" for renames, None for the /dev/null side of a textual addition
+    or deletion) to its filtered diff, and the set of binary file names.
+    """
+    files = set()
+    diffs = {}
+    binary_files = set()
+    is_binary = False
+    a_path = b_path = None
+    file_started = False
+    file_lines = []
+
+    def flush():
+        if not file_started:
+            return
+        files.update(path for path in (a_path, b_path) if path is not None)
+        file_name = f"{a_path} -> {b_path}" if a_path != b_path else a_path
+        diffs[file_name] = filter_diff_lines('\n'.join(file_lines))
+        if is_binary:
+            binary_files.add(file_name)
+
+    for line in patch_lines:
+        if line.startswith('diff --git '):
+            flush()
+            # "diff --git <path> <path>": both halves are equal unless renamed
+            paths = line[len('diff --git '):]
+            a_path = b_path = paths[:(len(paths) - 1) // 2]
+            file_started = True
+            is_binary = False
+            file_lines = []
+        elif file_lines or line.startswith('@@'):
+            file_lines.append(line)
+        elif line == '--- /dev/null':
+            a_path = None
+        elif line == '+++ /dev/null':
+            b_path = None
+        elif line.startswith('Binary files '):
+            is_binary = True
+        elif line.startswith('rename from '):
+            a_path = line[len('rename from '):]
+        elif line.startswith('rename to '):
+            b_path = line[len('rename to '):]
+    flush()
+
+    return sorted(files), diffs, binary_files
+
+
+# Prompt builders only read diff[:1000] of each file, so this policy leaves prompts unchanged
+# apart from skipped lockfiles and generated files.
+DEFAULT_CAPTURE_POLICY = {
+    'max_file_chars': 1000,
+    'max_file_lines': None,
+    'max_commit_chars': None,
+    'max_commit_lines': None,
+    'skip_binary': True,
+    'skip_globs': [
+        '*.lock', '*-lock.json', '*-lock.yaml', 'go.sum',
+        '*.min.js', '*.min.css', '*.map', '*_pb2.py', '*.pb.go', '*.pb.cc', '*.pb.h',
+        'vendor/*', '*/vendor/*', 'node_modules/*', '*/node_modules/*', 'dist/*',
+    ],
+}
+
+
+def apply_capture_policy(commit, binary_files, policy=DEFAULT_CAPTURE_POLICY):
+    """
+    Shrinks the diffs of a commit in place according to a capture policy.
+
+    Binary files and paths matching one of the skip globs keep an empty diff and
+    are listed in commit['skipped_files'] with the reason. The other diffs are cut
+    to the per-file line/char budgets, then to what is left of the per-commit
+    budgets (None disables a budget). The filtered line count of every file before
+    any cut is recorded in commit['diff_lines'].
+    """
+    diff_lines = {}
+    skipped_files = {}
+    commit_chars = 0
+    commit_lines = 0
+
+    for file_name, diff in commit['diffs'].items():
+        lines = diff.splitlines()
+        diff_lines[file_name] = len(lines)
+
+        if policy['skip_binary'] and file_name in binary_files:
+            skipped_files[file_name] = 'binary'
+        elif any(fnmatch(path, pattern) for path in file_name.split(' -> ') for pattern in policy['skip_globs']):
+            skipped_files[file_name] = 'generated'
+        if file_name in skipped_files:
+            commit['diffs'][file_name] = ''
+            continue
+
+        if policy['max_file_lines'] is not None:
+            lines = lines[:policy['max_file_lines']]
+        if policy['max_commit_lines'] is not None:
+            lines = lines[:max(0, policy['max_commit_lines'] - commit_lines)]
+        diff = '\n'.join(lines)
+        if policy['max_file_chars'] is not None:
+            diff = diff[:policy['max_file_chars']]
+        if policy['max_commit_chars'] is not None:
+            diff = diff[:max(0, policy['max_commit_chars'] - commit_chars)]
+
+        commit_chars += len(diff)
+        commit_lines += len(diff.splitlines())
+        commit['diffs'][file_name] = diff
+
+    commit['diff_lines'] = diff_lines
+    commit['skipped_files'] = skipped_files
+    return commit
+
 
-    for i, commit in enumerate(commits):
-        commits_dict[i] = {
-            'hash': commit.hexsha,
-            'author': f"{commit.author.name} <{commit.author.email}>",
-            'date': commit.authored_datetime,
-            'message': commit.message.strip(),
-            'files': list(commit.stats.files.keys()),
-            'diffs': {},
+def iter_git_commits(repo_path, branch='master', hashes=None, capture_policy=None):
+    """
+    Generator version of `extract_git_commits_streaming`: yields (index, commit)
+    pairs one at a time, so only the commit being processed is held in memory.
+    """
+    for i, (fields, patch_lines) in enumerate(iter_git_log(repo_path, branch, hashes)):
+        hexsha, name, email, date, message = fields
+        files, diffs, binary_files = parse_git_patch(patch_lines)
+        commit = Commit({
+            'hash': hexsha,
+            'author': f"{name} <{email}>",
+            'date': datetime.fromisoformat(date),
+            'message': message.strip(),
+            'files': files,
+            'diffs': diffs,
             'llama_summary': '',
             'llama_category': '',
             'llama_tech_summary': ''
-        }
+        })
+        if capture_policy is not None:
+            apply_capture_policy(commit, binary_files, capture_policy)
+        yield i, commit
 
-        diffs = commit.diff(commit.parents[0] if commit.parents else None, create_patch=True)
 
-        for diff in diffs:
-            file_diff = diff.diff.decode('utf-8')
-            file_name = f"{diff.a_path} -> {diff.b_path}" if diff.a_path != diff.b_path else diff.a_path
-            commits_dict[i]['diffs'][file_name] = filter_diff_lines(file_diff)
+def extract_git_commits_streaming(repo_path, branch='master', hashes=None, capture_policy=None):
+    """
+    Extracts commit information from a Git repository with a single `git log -p`
+    process instead of per-commit GitPython calls.
+    Produces the same commit dicts as `extract_git_commits`, except that the root
+    commit is diffed against the empty tree rather than the working tree and
+    non-ASCII paths in 'files' are not C-quoted.
+    If capture_policy is given, diffs are budgeted as described in apply_capture_policy.
+    """
+    commits_dict = dict(iter_git_commits(repo_path, branch, hashes, capture_policy))
 
     print(f"Extracted {len(commits_dict)} commits")
     return commits_dict
 
 
-def filter_trivial_commits(commits_dict, trivial_patterns=None, min_diff_lines=5):
+TRIVIAL_PATTERNS = [
+    r"merge branch",        # Merging branches
+    r"fix typo",            # Fixing typos
+    r"readme",              # Updating documentation
+    r"minor",               # General minor changes
+    r"release",             # Release versions
+    r"cleanup"              # Cleanups
+]
+
+
+def iter_filter_trivial_commits(commits, trivial_patterns=None, min_diff_lines=5):
     """
-    Filters out trivial commits based on patterns and diff size.
-    To add a new trivial pattern, add it to the trivial_patterns list below.
+    Generator version of `filter_trivial_commits`: takes and yields (index, commit)
+    pairs, dropping trivial commits as they stream through.
+    To add a new trivial pattern, add it to TRIVIAL_PATTERNS above.
     """
 
     if trivial_patterns is None:
-        trivial_patterns = [
-            r"merge branch",        # Merging branches
-            r"fix typo",            # Fixing typos
-            r"readme",              # Updating documentation
-            r"minor",               # General minor changes
-            r"release",             # Release versions
-            r"cleanup"              # Cleanups
-        ]
-
-    filtered_commits = {}
+        trivial_patterns = TRIVIAL_PATTERNS
+
     filtered_number = 0
 
-    for index, commit in commits_dict.items():
+    for index, commit in commits:
         # Check commit message for trivial patterns
         if any(re.search(pattern, commit['message'], re.IGNORECASE) for pattern in trivial_patterns):
             filtered_number += 1
             continue
 
-        # Check diff size (number of lines changed)
-        total_diff_lines = sum(len(diff.splitlines()) for diff in commit['diffs'].values())
+        # Check diff size (number of lines changed), counted before any capture budget
+        if 'diff_lines' in commit:
+            total_diff_lines = sum(commit['diff_lines'].values())
+        else:
+            total_diff_lines = sum(len(diff.splitlines()) for diff in commit['diffs'].values())
         if total_diff_lines < min_diff_lines:
             filtered_number += 1
             continue
 
         # If commit passes all filters, include it
-        filtered_commits[index] = commit
+        yield index, commit
 
     print(f"Filtered {filtered_number} commits")
-    return filtered_commits
 
 
-def normalize_commit_data(commit_data):
+def filter_trivial_commits(commits_dict, trivial_patterns=None, min_diff_lines=5):
     """
-    Normalize all commit messages in a dictionary of git data.
+    Filters out trivial commits based on patterns and diff size.
     """
+    return dict(iter_filter_trivial_commits(commits_dict.items(), trivial_patterns, min_diff_lines))
 
-    def normalize_message(message):
-        """
-        Normalize a single git commit message.
-        """
-        # Remove leading/trailing whitespace and ensure capitalization
-        normalized = message.strip().capitalize()
 
-        # Replace multiple spaces or tabs with a single space
-        normalized = re.sub(
-          r'\s+', ' ', normalized)
+def normalize_message(message):
+    """
+    Normalize a single git commit message.
+    """
+    # Remove leading/trailing whitespace and ensure capitalization
+    normalized = message.strip().capitalize()
+
+    # Replace multiple spaces or tabs with a single space
+    normalized = re.sub(
+      r'\s+', ' ', normalized)
 
-        # Remove repetitive or excessive comments like "!!!!!" or "..."
-        normalized = re.sub(r'[!?.]{2,}', '.', normalized)
+    # Remove repetitive or excessive comments like "!!!!!" or "..."
+    normalized = re.sub(r'[!?.]{2,}', '.', normalized)
 
-        # Eliminate redundant phrases or filler words
-        redundant_phrases = [
-            r"\bthis commit\b", r"\bminor fix\b", r"\bsmall update\b",
-            r"\bquick fix\b", r"\btemporary change\b", r"\btest commit\b"
-        ]
-        for phrase in redundant_phrases:
-            normalized = re.sub(phrase, '', normalized, flags=re.IGNORECASE).strip()
+    # Eliminate redundant phrases or filler words
+    redundant_phrases = [
+        r"\bthis commit\b", r"\bminor fix\b", r"\bsmall update\b",
+        r"\bquick fix\b", r"\btemporary change\b", r"\btest commit\b"
+    ]
+    for phrase in redundant_phrases:
+        normalized = re.sub(phrase, '', normalized, flags=re.IGNORECASE).strip()
 
-        # Simplify common patterns
-        normalized = re.sub(r'\bAdded\b', 'Add', normalized, flags=re.IGNORECASE)
-        normalized = re.sub(r'\bRemoved\b', 'Remove', normalized, flags=re.IGNORECASE)
-        normalized = re.sub(r'\bFixed\b', 'Fix', normalized, flags=re.IGNORECASE)
+    # Simplify common patterns
+    normalized = re.sub(r'\bAdded\b', 'Add', normalized, flags=re.IGNORECASE)
+    normalized = re.sub(r'\bRemoved\b', 'Remove', normalized, flags=re.IGNORECASE)
+    normalized = re.sub(r'\bFixed\b', 'Fix', normalized, flags=re.IGNORECASE)
 
-        # Standardize specific keywords
-        normalized = re.sub(r'\bBugfix\b', 'Bug fix', normalized, flags=re.IGNORECASE)
-        normalized = re.sub(r'\bRefactored\b', 'Refactor', normalized, flags=re.IGNORECASE)
+    # Standardize specific keywords
+    normalized = re.sub(r'\bBugfix\b', 'Bug fix', normalized, flags=re.IGNORECASE)
+    normalized = re.sub(r'\bRefactored\b', 'Refactor', normalized, flags=re.IGNORECASE)
 
-        # Ensure the message ends with a period if it doesn't already
-        if not normalized.endswith('.'):
-            normalized += '.'
+    # Ensure the message ends with a period if it doesn't already
+    if not normalized.endswith('.'):
+        normalized += '.'
 
-        return normalized
+    return normalized
 
-    # Iterate through each commit and normalize the message
-    for index, commit in commit_data.items():
+
+def iter_normalize_commit_data(commits):
+    """
+    Generator version of `normalize_commit_data`: takes and yields (index, commit) pairs.
+    """
+    for index, commit in commits:
         if "message" in commit:
             commit["message"] = normalize_message(commit["message"])
+        yield index, commit
 
     print("Normalize commits done")
+
+
+def normalize_commit_data(commit_data):
+    """
+    Normalize all commit messages in a dictionary of git data.
+    """
+    for _ in iter_normalize_commit_data(commit_data.items()):
+        pass
     return commit_data
 
+
+def iter_commits_pipeline(repo_path, branch='master', hashes=None, capture_policy=None):
+    """
+    Chains extraction, trivial-commit filtering and normalization as generators.
+    Trivial commits are dropped as soon as they are parsed, so memory stays bounded
+    by the largest single commit rather than by the length of the history.
+    """
+    commits = iter_git_commits(repo_path, branch, hashes, capture_policy)
+    commits = iter_filter_trivial_commits(commits)
+    return iter_normalize_commit_data(commits)
+
+
+def commit_exists(repo_path, hexsha):
+    """
+    Returns True if hexsha names a commit in the repository.
+    """
+    result = subprocess.run(['git', '-C', repo_path, 'cat-file', '-e', f"{hexsha}^{{commit}}"],
+                            stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+def _extract_commit_chunk(repo_path, hashes, capture_policy=None):
+    """
+    Worker for extract_git_commits_parallel: extracts, filters and normalizes
+    one chunk of commits and returns them in chunk order.
+    """
+    # Per-chunk progress messages would interleave across workers
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return [commit for _, commit in iter_commits_pipeline(repo_path, hashes=hashes, capture_policy=capture_policy)]
+
+
+def extract_git_commits_parallel(repo_path, branch='master', workers=4, chunk_size=500, capture_policy=None):
+    """
+    Runs extraction, filtering and normalization over a process pool.
+    The commit range is listed once with `git rev-list`, split into hash chunks
+    and the results are merged back in commit order, so the output (keyed by
+    hash) is the same as running the three stages serially.
+    """
+    hashes = subprocess.run(['git', '-C', repo_path, 'rev-list', branch],
+                            stdout=subprocess.PIPE, check=True, text=True).stdout.split()
+    chunks = [hashes[i:i + chunk_size] for i in range(len(hashes))[::chunk_size]]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_extract_commit_chunk, [repo_path] * len(chunks), chunks, [capture_policy] * len(chunks))
+        commits = {commit['hash']: commit for chunk in results for commit in chunk}
+
+    print(f"Extracted {len(hashes)} commits with {workers} workers, kept {len(commits)}")
+    return commits
+
+
+def new_commits_revision(repo_path, watermarks, branch='master'):
+    """
+    Returns the revision range of the commits added to branch since the last run
+    and the current branch tip. If the recorded hash is gone (e.g. history was
+    rewritten), the whole branch is returned.
+    """
+    last_seen = watermarks.get(branch)
+    if last_seen and commit_exists(repo_path, last_seen):
+        revision = f"{last_seen}..{branch}"
+    else:
+        revision = branch
+
+    tip = subprocess.run(['git', '-C', repo_path, 'rev-parse', branch],
+                         stdout=subprocess.PIPE, check=True, text=True).stdout.strip()
+    return revision, tip
+
+
+def iter_new_commits(repo_path, watermarks, branch='master', capture_policy=None):
+    """
+    Generator version of `extract_new_commits`: yields the new, non-trivial,
+    normalized commits one at a time and moves the watermark once all are yielded.
+    """
+    revision, tip = new_commits_revision(repo_path, watermarks, branch)
+    for _, commit in iter_commits_pipeline(repo_path, revision, capture_policy=capture_policy):
+        yield commit
+    watermarks[branch] = tip
+
+
+def extract_new_commits(repo_path, watermarks, branch='master', workers=1, capture_policy=None):
+    """
+    Extracts, filters and normalizes only the commits added to branch since the
+    last run, keyed by commit hash.
+    watermarks maps each branch to the newest hash already processed and is
+    updated in place. With workers > 1 the work is spread over a process pool.
+    """
+    if workers <= 1:
+        return {commit['hash']: commit for commit in iter_new_commits(repo_path, watermarks, branch, capture_policy)}
+
+    revision, tip = new_commits_revision(repo_path, watermarks, branch)
+    commits = extract_git_commits_parallel(repo_path, revision, workers, capture_policy=capture_policy)
+    watermarks[branch] = tip
+    return commits
+
+
+def key_commits_by_hash(commits):
+    """
+    Re-keys a commits dict by commit hash, so keys stay stable as history grows.
+    Stores saved with positional keys are migrated transparently.
+    """
+    return {commit['hash']: commit for commit in commits.values()}
+
+
+def merge_commits(new_commits, commits):
+    """
+    Merges commits into an existing store keyed by hash, newest first.
+    Records already in the store are kept untouched (with their model outputs).
+    """
+    merged = {hexsha: commit for hexsha, commit in new_commits.items() if hexsha not in commits}
+    merged.update(commits)
+    return merged
+
+
+OUTPUT_FIELDS = ('llama_summary', 'llama_category', 'llama_tech_summary')
+
+
+def make_experiment(commits, outputs):
+    """
+    Builds the commits of one experiment as views over the shared commit records.
+
+    Each view is a ChainMap of the experiment's own outputs for that commit and a
+    read-only proxy of the shared record, so prompt builders read it like a commit
+    dict while every assignment (e.g. commit['llama_category'] = ...) lands in
+    outputs[hash]. outputs gets an (empty) entry for every commit and is the only
+    thing an experiment needs to persist.
+    """
+    return {hexsha: ChainMap(outputs.setdefault(hexsha, {}), MappingProxyType(record))
+            for hexsha, record in commits.items()}
+
+
+def load_experiment_outputs(file_path):
+    """
+    Loads the per-commit outputs of an experiment, keyed by hash.
+    Stores written by older runs, which held full commit copies, are reduced to their outputs.
+    """
+    stored = load_commits(file_path) or {}
+    outputs = {}
+    for key, entry in stored.items():
+        if 'diffs' in entry:
+            outputs[entry['hash']] = {field: entry[field] for field in OUTPUT_FIELDS if field in entry}
+        else:
+            outputs[key] = entry
+    return outputs
+
+
+def compare_experiments(commits, experiments, field='llama_category'):
+    """
+    Lines up one output field of several experiments side by side.
+    experiments maps an experiment name to its outputs; returns hash -> {name: value}.
+    """
+    return {hexsha: {name: outputs.get(hexsha, {}).get(field, record.get(field, '')) for name, outputs in experiments.items()}
+            for hexsha, record in commits.items()}
+
 def clean_text_paragraph(text):
     """
     Cleans a text paragraph by removing unnecessary blank lines
@@ -154,27 +609,17 @@ def clean_text_paragraph(text):
 
 
 def plot_categories(commits, shot_method):
-    commit_counts = defaultdict(lambda: defaultdict(int))
-
-    def get_quarter(date):
-        month = date.month
-        quarter = (month - 1) // 3 + 1  # Calculate the quarter (1 to 4)
-        return f"{date.year}-Q{quarter}"
-
-    for idx, commit in commits.items():
-        if commit['llama_category'] == '':
-            continue
-        quarter = get_quarter(commit['date'])
-        category = commit['llama_category']
-        commit_counts[category][quarter] += 1
+    """
+    Plots the number of commits per category and quarter.
+    commits can be a commits dict or a commit table (see analytics.load_commit_table).
+    """
+    from matplotlib import pyplot as plt  # Imported on first plot, it is slow to import
 
-    categories = commit_counts.keys()
-    quarters = sorted({quarter for category_data in commit_counts.values() for quarter in category_data})  # Sorted unique quarters
+    categories, quarters, counts = count_categories_by_quarter(as_commit_table(commits))
 
     plt.figure(figsize=(10, 6))
-    for category in categories:
-        counts = [commit_counts[category][quarter] if quarter in commit_counts[category] else 0 for quarter in quarters]
-        plt.plot(quarters, counts, marker='o', label=category)
+    for category, category_counts in zip(categories, counts):
+        plt.plot(quarters, category_counts, marker='o', label=category)
 
     plt.title('Commit Classification Over Time')
     plt.xlabel('Quarter')
@@ -191,16 +636,16 @@ def plot_categories(commits, shot_method):
 
 
 def plot_categories_piechart(commits,shot_method):
-    commit_counts = defaultdict(int)
-
-    for idx, commit in commits.items():
-        if commit['llama_category'] == '':
-            continue
-        category = commit['llama_category']
-        commit_counts[category] += 1
+    """
+    Plots the share of each category.
+    commits can be a commits dict or a commit table (see analytics.load_commit_table).
+    """
+    from matplotlib import pyplot as plt
 
-    categories = commit_counts.keys()
-    counts = [commit_counts[category] for category in categories]
+    categories, counts = count_categories(as_commit_table(commits))
+    if not counts.sum():
+        print(f"No categorized commits to plot for {shot_method}")
+        return
 
     plt.figure(figsize=(8, 8))
     plt.pie(counts, labels=categories, autopct='%1.1f%%', startangle=140)
@@ -212,28 +657,86 @@ def full_path(DATA_FILEPATH, name_file):
   path = os.path.join(DATA_FILEPATH, f"commits_{name_file}.pkl" )
   return path
 
+def journal_path(file_path):
+    """
+    Returns the path of the append-only journal that goes with a commits pickle.
+    """
+    return f"{os.path.splitext(file_path)[0]}.journal"
+
+
 def save_commits(commits, file_path):
     """
     Save commits to a file using pickle, creating directories if they do not exist.
+    The file is replaced atomically, and the journal of updates it now contains is removed.
     """
     # Ensure the directory exists
     directory = os.path.dirname(file_path)
-    if not os.path.exists(directory):
+    if directory and not os.path.exists(directory):
         os.makedirs(directory)
 
-    # Now save the commits to the file
-    with open(file_path, "wb") as file:
+    # Write a temporary file and swap it in, so a killed run never leaves a truncated pickle
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, "wb") as file, pickled_in(directory or '.'):  # Stored diffs relative to the pickle
         pickle.dump(commits, file)
+    os.replace(temporary_path, file_path)
+
+    if os.path.exists(journal_path(file_path)):
+        os.remove(journal_path(file_path))
     #print(f"Commits saved to {file_path}")
 
+
+JOURNAL_LOCK = threading.Lock()  # Chains annotating concurrently append to the same journals
+
+def save_commit_fields(commit, fields, file_path):
+    """
+    Checkpoints the given fields of one commit by appending a single line to the
+    journal of file_path, instead of re-pickling the whole store.
+    """
+    directory = os.path.dirname(file_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    entry = {'hash': commit['hash'], 'fields': {field: commit[field] for field in fields}}
+    with JOURNAL_LOCK, open(journal_path(file_path), "a", encoding="utf-8") as file:
+        file.write(json.dumps(entry) + "\n")
+
+
+def replay_journal(commits, file_path):
+    """
+    Applies the journaled field updates to the commits they belong to.
+    A partially written last line (run killed mid-append) is ignored.
+    Returns the number of updates applied.
+    """
+    # Full commit records carry their hash, experiment outputs are keyed by it
+    commits_by_hash = {commit.get('hash', key): commit for key, commit in commits.items()}
+    applied = 0
+    with open(journal_path(file_path), encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if entry['hash'] in commits_by_hash:
+                commits_by_hash[entry['hash']].update(entry['fields'])
+                applied += 1
+    return applied
+
+
 def load_commits(file_path):
     """
     Load commits from a file if available.
+    Pending journal updates are replayed and compacted into the pickle, so loading
+    costs the same however many commits were checkpointed.
     """
-    if os.path.exists(file_path):
-        with open(file_path, "rb") as file:
-            return pickle.load(file)
-    return None
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "rb") as file, pickled_in(os.path.dirname(file_path) or '.'):
+        commits = pickle.load(file)
+
+    if os.path.exists(journal_path(file_path)):
+        replay_journal(commits, file_path)
+        save_commits(commits, file_path)
+    return commits
 
 
 def save_variable(variable, file_path):
@@ -259,31 +762,6 @@ def calculate_precision_recall_categorization(commits, ground_truth):
   Returns the precision and recall of the commits.
   Note that ground_truth is a list where ground_truth[i] is the category of the i-th commit.
   Should be handcrafted or GPT generated.
+  commits can be a commits dict or a commit table (see analytics.load_commit_table).
   """
-
-  TP = 0
-  TN = 0
-  FP = 0
-  FN = 0
-
-  for i, commit in commits.items():
-    if i >= 100:
-      break
-    predicted = commit['llama_category']
-    actual = ground_truth[i]
-    if predicted == actual:
-      if predicted == 'Other':
-        TN += 1
-      else:
-        TP += 1
-    else:
-      if predicted == 'Other':
-        FN += 1
-      else:
-        FP += 1
-
-  accuracy = (TP + TN) / (TP + TN + FP + FN)
-  precision = TP / (TP + FP) if TP + FP > 0 else 0
-  recall = TP / (TP + FN) if TP + FN > 0 else 0
-
-  return precision, recall, accuracy
\ No newline at end of file
+  return precision_recall_from_table(as_commit_table(commits), ground_truth)